@@ -1,11 +1,16 @@
 import hashlib
 import os,sys
-import shutil
+import struct
 import logging
-from typing import List
+import warnings
+from functools import cached_property
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, Iterable, List, Tuple
 
 from ApkParse.parser.zip_parser import ZipFile
-from ApkParse.parser.res_parser import Axml, Arsc
+from ApkParse.parser.range_reader import CachedRangeReader
+from ApkParse.parser.res_parser import Axml, Arsc, RES_XML_TYPE
+from ApkParse.parser.manifest_parser import ManifestIndex
 
 # log设置
 logging.basicConfig(
@@ -28,98 +33,197 @@ COMMON_KEYS = [
     "platformBuildVersionName",
 ]
 
+DIGEST_ALGORITHMS = ("sha1",)  # 默认只计算sha1，多算的hash会让非lazy模式下读取sha1时等待更久
+HASH_CHUNK_SIZE = 1024 * 1024   # 计算hash时每次读取的大小
+
 class ApkFile:
-    def __init__(self, file_path) -> None:
+    def __init__(self, file_path, digest_algorithms:Iterable[str] = DIGEST_ALGORITHMS, lazy:bool = False) -> None:
+        '''
+        Args:
+            file_path: apk文件路径
+            digest_algorithms: 后台计算的hash算法(hashlib中的名称)，sha1总是会计算，
+                如 ("md5", "sha1", "sha256")，会在读取文件的同一遍中一起计算
+            lazy: 为True时manifest, resources以及各项基本信息都在第一次访问时才解析，之后缓存结果；
+                只需要包名、版本等少量信息时可以省掉大部分耗时(resources.arsc只在属性值为资源id时才解析)
+        '''
         self.file_path = file_path
         self.zip = ZipFile(file_path)
         if not self.zip.is_init:
             raise Exception("Zip error!!")
-        self.manifest = Axml(self.zip.get_file(b"AndroidManifest.xml"))
-        self.resources = Arsc(self.zip.get_file(b"resources.arsc"))
 
-        self.common_k_v = {}    # 保存manifest中常用字段
-        manifest_attrs = self.manifest.start_elements[0].attributes
-        for item in manifest_attrs:
-            name_str = self.manifest._parse_name(item.name)
-            if name_str in COMMON_KEYS:     # 只取指定数据，防止manifest恶意加入乱七八糟的东西
-                name_value = item.value.parse_data(self.manifest.string_pool)
-                if isinstance(name_value, str) and name_value.startswith("0x"):   # 过滤掉返回值为资源ID的16进制值，例如：'0x7f0b0039'
-                    self.common_k_v[name_str] = self.resources.get_resources(int(name_value, base=16))[0][-1]
-                else:
-                    self.common_k_v[name_str] = name_value
-        
-        self.flag = 0   # 标记是否解析了基本数据
-        self._set_basic_info()
-
-    def _set_basic_info(self):
-        with open(self.file_path, 'rb') as fr:
-            self.sha1 = hashlib.sha1(fr.read()).hexdigest()
-        self.app_name = self.get_app_name()
-        self.version = self.common_k_v.get('versionName', '')
-        self.package = self.common_k_v.get('package', '')
+        # 在后台线程计算文件hash，和下面的解析同时进行(hashlib处理大块数据时会释放GIL)
+        # lazy模式下不在后台计算，第一次调用digests()时再计算
+        self._digests:Dict[str, str] = {}
+        self._digests_future:Future = None
+        self._digest_algorithms = tuple(dict.fromkeys((*digest_algorithms, "sha1")))
+        if not lazy:
+            executor = ThreadPoolExecutor(max_workers=1)
+            self._digests_future = executor.submit(self._hash_file, self._digest_algorithms)
+            executor.shutdown(wait=False)
+
         self.cert = ''          # 完整的证书，包括subject和issuer
         self.cert_name = ''     # subject的名称
         self.cert_sha1 = ''     # 证书hash
-        self.main_activity = self.get_main_activity()
-        self.services = []
-        self.receivers = []
-        self.providers = []
-        self.activitise = []
         self.icon_ls = []       # apk图标文件路径的列表
-        self.flag = 1
+
+        if lazy:
+            self.zip.prefetch([b"AndroidManifest.xml"])
+            return
+
+        # 远程读取时把两个文件合并成一次请求
+        self.zip.prefetch([b"AndroidManifest.xml", b"resources.arsc"])
+        for name in ("manifest", "resources", "common_k_v", "sha1", "app_name", "version", "package", "main_activity"):
+            getattr(self, name)
+
+    @cached_property
+    def _manifest_data(self) -> bytes:
+        return self.zip.get_file(b"AndroidManifest.xml")
+
+    @cached_property
+    def manifest(self) -> Axml:
+        return Axml(self._manifest_data)
+
+    @cached_property
+    def resources(self) -> Arsc:
+        return Arsc(self.zip.get_file(b"resources.arsc"))
+
+    @cached_property
+    def common_k_v(self) -> dict:
+        '''
+        manifest中常用字段
+        '''
+        common_k_v = {}
+        # 只需要manifest根节点的属性，不用解析整个manifest
+        manifest_attrs = Axml.read_root_attributes(self._manifest_data)
+        for name_str, name_value in manifest_attrs.items():
+            if name_str in COMMON_KEYS:     # 只取指定数据，防止manifest恶意加入乱七八糟的东西
+                if isinstance(name_value, str) and name_value.startswith("0x"):   # 过滤掉返回值为资源ID的16进制值，例如：'0x7f0b0039'
+                    common_k_v[name_str] = self.resources.get_resources(int(name_value, base=16))[0][-1]
+                else:
+                    common_k_v[name_str] = name_value
+        return common_k_v
+
+    @cached_property
+    def sha1(self) -> str:
+        return self.digests(("sha1",))["sha1"]
+
+    @cached_property
+    def version(self) -> str:
+        return self.common_k_v.get('versionName', '')
+
+    @cached_property
+    def package(self) -> str:
+        return self.common_k_v.get('package', '')
+
+    @cached_property
+    def app_name(self) -> str:
+        # http://schemas.android.com/apk/res/android 这个命名空间是固定死的
+        label = self.manifest.node_ptr.find("application").get("{http://schemas.android.com/apk/res/android}label", "")
+        # 有的apk文件会抹掉命名空间 ，遍历application查找label字符串
+        if not label:
+            for child in self.manifest.node_ptr.find("application").iter():
+                if "application" != child.tag.lower():
+                    continue
+                for key,value in dict(child.attrib).items():
+                    if "label" in key.lower():
+                        label = value
+                        break
+
+        # 有的apk这里会直接返回应用名称而不是资源ID
+        num = 0 # 可能会出现死循环，保险起见加个限制（比如appname刚好等于资源id的值）
+        while (label.startswith('0x') and num < 10):
+            label = self.resources.get_resources(int(label,base=16))[0][-1]
+            num += 1
+        return label
+
+    @cached_property
+    def manifest_index(self) -> ManifestIndex:
+        '''
+        manifest中的组件索引，可以按action, category查找组件
+        '''
+        # 已经解析过manifest时复用它的字符串池和名称缓存，否则只流式读取，不创建xml树
+        if "manifest" in self.__dict__:
+            axml = self.manifest
+        else:
+            axml = Axml(self._manifest_data, build_tree=False)
+        return ManifestIndex(axml.iter_events())
+
+    @cached_property
+    def main_activity(self) -> str:
+        ret = self.manifest_index.get_main_activity()
+        if ret is None:
+            return "not_found_main_activity!!"
+        return ret
+
+    @cached_property
+    def activitise(self) -> List[str]:
+        return [c.name for c in self.manifest_index.activities]
+
+    @cached_property
+    def services(self) -> List[str]:
+        return [c.name for c in self.manifest_index.services]
+
+    @cached_property
+    def receivers(self) -> List[str]:
+        return [c.name for c in self.manifest_index.receivers]
+
+    @cached_property
+    def providers(self) -> List[str]:
+        return [c.name for c in self.manifest_index.providers]
+
+    def _hash_file(self, algorithms:Tuple[str, ...]) -> Dict[str, str]:
+        '''
+        分块读取整个文件一次，同时计算多个hash
+        '''
+        hashes = [hashlib.new(name) for name in algorithms]
+        reader = self.zip.reader
+        # 不经过块缓存读取，避免把解析需要的数据挤出缓存
+        if isinstance(reader, CachedRangeReader):
+            reader = reader.reader
+        for offset in range(0, reader.size, HASH_CHUNK_SIZE):
+            chunk = reader.read(offset, HASH_CHUNK_SIZE)
+            for h in hashes:
+                h.update(chunk)
+            if isinstance(chunk, memoryview):
+                chunk.release()
+        return {name: h.hexdigest() for name, h in zip(algorithms, hashes)}
+
+    def digests(self, algorithms:Iterable[str] = None) -> Dict[str, str]:
+        '''
+        获取文件的hash，结果会缓存，之前没有计算过的算法会再读一遍文件计算
+
+        Args:
+            algorithms: hash算法的名称，如 ("md5", "sha256")，默认为创建时指定的算法
+        return:
+            {算法名称: 16进制的hash}
+        '''
+        if self._digests_future is not None:
+            future, self._digests_future = self._digests_future, None
+            self._digests.update(future.result())
+        if algorithms is None:
+            algorithms = self._digest_algorithms
+        missing = tuple(name for name in dict.fromkeys(algorithms) if name not in self._digests)
+        if missing and not self._digests:
+            # 第一次计算时把创建时指定的算法一起算了，避免之后再读一遍文件
+            missing = tuple(dict.fromkeys((*self._digest_algorithms, *missing)))
+        if missing:
+            self._digests.update(self._hash_file(missing))
+        return {name: self._digests[name] for name in algorithms}
 
     def get_basic_info(self) -> list:
         return [self.sha1, self.app_name, self.version, self.package, self.cert_name, self.cert_sha1, self.main_activity]
 
     def get_app_name(self) -> str:
-        ret = ""
-        if self.flag:
-            ret = self.app_name
-        else:
-            # http://schemas.android.com/apk/res/android 这个命名空间是固定死的
-            label = self.manifest.node_ptr.find("application").get("{http://schemas.android.com/apk/res/android}label", "")
-            # 有的apk文件会抹掉命名空间 ，遍历application查找label字符串
-            if not label:
-                for child in self.manifest.node_ptr.find("application").iter():
-                    if "application" != child.tag.lower():
-                        continue
-                    for key,value in dict(child.attrib).items():
-                        if "label" in key.lower():
-                            label = value
-                            break
-
-            # 有的apk这里会直接返回应用名称而不是资源ID
-            num = 0 # 可能会出现死循环，保险起见加个限制（比如appname刚好等于资源id的值）
-            while (label.startswith('0x') and num < 10):
-                label = self.resources.get_resources(int(label,base=16))[0][-1]
-                num += 1
-            ret = label
-
-        return ret
+        return self.app_name
 
     def get_main_activity(self) -> str:
-        if self.flag:
-            return self.main_activity
-        else:
-            # 先定位android.intent.action.MAIN，之后找上两级的element，确定element为activity则成功获取到结果
-            for item in self.manifest.node_ptr.iter("action"):
-                if item.get("{http://schemas.android.com/apk/res/android}name") != "android.intent.action.MAIN":
-                    continue
+        return self.main_activity
 
-                category = item.getparent().iter("category")
-                for i in category:
-                    # print(i.get("{http://schemas.android.com/apk/res/android}name"))
-                    if i.get("{http://schemas.android.com/apk/res/android}name") != "android.intent.category.LAUNCHER":
-                        continue
-                    
-                    target_element = item.getparent().getparent()
-                    if target_element.tag == "activity":
-                        ret = target_element.get("{http://schemas.android.com/apk/res/android}name")
-                        if not ret:
-                            ret = target_element.get("name")    #activity可以没有namespace
-                        return ret
-
-        return "not_found_main_activity!!"
+    def get_permissions(self) -> List[str]:
+        '''
+        申请的权限(uses-permission)
+        '''
+        return self.manifest_index.permissions
 
     def get_icons(self) -> List[str]:
         """获取全部图标路径, 格式为列表
@@ -167,16 +271,10 @@ class ApkFile:
 
 
     def get_package(self) -> str:
-        if self.flag:
-            return self.package
-        else:
-            return self.common_k_v.get('package', '')
+        return self.package
 
     def get_version(self) -> str:
-        if self.flag:
-            return self.version
-        else:
-            return self.common_k_v.get('versionName', '')
+        return self.version
 
     def get_file(self, fname:bytes) -> bytes:
         '''
@@ -190,6 +288,45 @@ class ApkFile:
         '''
         return self.manifest.get_xml_str()
 
+    def write_xml(self, fname:bytes, sink, indent:str = "  ", render_refs:bool = False) -> None:
+        '''
+        把apk中的二进制xml直接写成文本xml，不创建xml树，见Axml.write_xml()
+
+        Args:
+            fname: 文件名，如 b"AndroidManifest.xml", b"res/layout/main.xml"
+            sink: 文本流或二进制流
+        '''
+        axml = Axml(self.zip.get_file(fname), build_tree=False)
+        axml.write_xml(sink, indent, render_refs)
+
+    def export_xmls(self, out_path:str, render_refs:bool = False) -> int:
+        '''
+        把apk中全部的二进制xml转换成文本后写到out_path目录下，路径处理和unzip一致
+
+        return:
+            导出的文件数
+        '''
+        out_root = os.path.abspath(out_path).encode('utf-8')
+        count = 0
+        for fname in self.zip.cds.keys():
+            if not fname.endswith(b".xml"):
+                continue
+            parts = tuple(p for p in fname.split(b"/") if p not in (b"", b".", b".."))
+            if not parts:
+                continue
+            try:
+                data = self.zip.get_file(fname)
+                if struct.unpack_from("<H", data)[0] != RES_XML_TYPE:   # 不是二进制xml(如assets中的普通xml)
+                    continue
+                out_fname = os.path.join(out_root, *parts)
+                os.makedirs(os.path.dirname(out_fname), exist_ok=True)
+                with open(out_fname, 'wb') as fw:
+                    Axml(data, build_tree=False).write_xml(fw, render_refs=render_refs)
+                count += 1
+            except Exception as e:
+                logger.warning(f"export xml {fname} error: {e}")
+        return count
+
     def get_resources(self, res_id:int) -> list:
         '''
         输入资源id, 如 0x7f100010
@@ -198,43 +335,136 @@ class ApkFile:
         '''
         return self.resources.get_resources(res_id)
 
-    def unzip(self, out_path):
+    def close(self) -> None:
+        '''
+        关闭apk文件，释放zip的mmap
+        '''
+        if self._digests_future is not None:
+            # 等待后台的hash计算结束，否则关闭后还会读取文件
+            self._digests_future.exception()
+        self.zip.close()
+
+    def __enter__(self) -> "ApkFile":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def unzip(self, out_path:str, workers:int = None, max_size:int = None):
         '''
         解压apk中的全部文件
+
+        先统一创建全部文件夹，再用线程池并行解压，每个文件按块流式写入(zlib解压时会释放GIL)
+
+        文件名中的 ".." 和开头的 "/" 会被去掉，防止写到out_path以外的位置；
+        文件和文件夹重名时(如同时存在 a/b 和 a/b/c)，文件夹优先，文件重命名为 a/b~1 这种形式
+        多个文件规范化后同名时(如 a/b 和 ./a//b)，第一个保留原名，其他的同样重命名
+
+        params:
+            out_path: 输出目录
+            workers: 解压线程数，默认为cpu核数，小于等于1时单线程解压
+            max_size: 单个文件解压后的最大长度，超过时跳过此文件，默认不限制
         '''
-        zip_file = self.zip
-        for fname in zip_file.cds.keys():
-            out_fname = os.path.join(out_path.encode('utf-8'), fname)
-            fdir = b"/".join(out_fname.split(b"/")[:-1])
-            if len(fdir) >= 255:    # 文件名长度限制，只能跳过
+        out_root = os.path.abspath(out_path).encode('utf-8')
+        tasks = self._unzip_plan(out_root)
+
+        def _extract(task):
+            fname, out_fname = task
+            fw = None
+            try:
+                with self.zip.open_entry(fname, max_size=max_size) as fr, open(out_fname, 'wb') as fw:
+                    for chunk in fr:
+                        fw.write(chunk)
+            except Exception as e:
+                logger.warning(f"unzip {fname} error: {e}")
+                if fw is not None:
+                    # 删除只写了一部分的文件(如超过max_size)
+                    try:
+                        os.remove(out_fname)
+                    except OSError:
+                        pass
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers <= 1:
+            for task in tasks:
+                _extract(task)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                # 消费掉结果，保证全部任务完成
+                for _ in executor.map(_extract, tasks):
+                    pass
+
+    def _unzip_plan(self, out_root:bytes) -> List[Tuple[bytes, bytes]]:
+        '''
+        计算每个文件的输出路径并创建全部文件夹
+
+        return:
+            [(zip中的文件名, 输出路径), ...]
+        '''
+        files = []          # [(zip中的文件名, 输出路径的各级名称)]
+        dirs = set()
+        for fname in self.zip.cds.keys():
+            # 去掉空路径、"."和".."，防止路径穿越
+            parts = tuple(p for p in fname.split(b"/") if p not in (b"", b".", b".."))
+            if not parts:
                 continue
-            os.makedirs(fdir, exist_ok=True)
-            try:    # TODO 文件夹和文件重名时，会报错，所以用try跳过，目前不知道怎么解决
-                with open(out_fname, 'wb') as fw:
-                    fw.write(zip_file.get_file(fname))
-            except:
-                pass
+            if any(len(p) > 255 for p in parts):    # 文件名长度限制，只能跳过
+                logger.warning(f"unzip: file name too long, skip {fname}")
+                continue
+            for i in range(1, len(parts)):
+                dirs.add(parts[:i])
+            if fname.endswith(b"/"):    # 文件夹
+                dirs.add(parts)
+            else:
+                files.append((fname, parts))
+
+        os.makedirs(out_root, exist_ok=True)   # 全部文件都在根目录时dirs为空
+        for d in sorted(dirs):
+            os.makedirs(os.path.join(out_root, *d), exist_ok=True)
+
+        # 先占用全部不冲突的文件名，重命名时不会占用其他文件原本的名称
+        # 规范化后同名的文件(如assets/x.bin和./assets//x.bin)，按中心目录顺序第一个保留原名，其他的重命名，
+        # 否则多线程解压时会同时写同一个文件
+        tasks = []
+        used = dirs | set(parts for _, parts in files)
+        taken = set()       # 已经分配出去的输出路径
+        for fname, parts in files:
+            if parts in dirs or parts in taken:   # 和文件夹或者前面的文件重名
+                num = 1
+                while parts[:-1] + (parts[-1] + b"~%d" % num,) in used:
+                    num += 1
+                parts = parts[:-1] + (parts[-1] + b"~%d" % num,)
+                logger.warning(f"unzip: name conflict, {fname} -> {b'/'.join(parts)}")
+            used.add(parts)
+            taken.add(parts)
+            tasks.append((fname, os.path.join(out_root, *parts)))
+        return tasks
     
-    def re_zip(self, tmp_path:str, out_path:str, quiet:bool=True):
+    def re_zip(self, out_path:str, *args, align:int = 4, recompress:bool = False, level:int = 6, workers:int = None,
+               tmp_path:str = None, quiet:bool = None):
         '''
-        解压apk文件，再重新zip打包，某些apk可能有较复杂对抗，
+        重新打包成标准的zip文件，某些apk可能有较复杂对抗，
         无法直接用jeb等工具打开，可以用此方法重打包后再用jeb等其他分析工具分析
-        **此功能调用系统的zip命令进行打包，没有重签名**
+        **默认压缩数据直接复制，不会重新压缩，没有重签名**
+
+        兼容以前的调用方式 re_zip(tmp_path, out_path, quiet)，现在不需要临时文件夹，tmp_path和quiet会被忽略
 
         params:
-            tmp_path: 解压用的临时文件夹
             out_path: 最终输出的文件名
+            align: stored文件的对齐字节数，默认4字节，和zipalign一致
+            recompress: 多线程解压后重新压缩，可以修复压缩数据损坏的文件
+            level: 重新压缩时的压缩等级
+            workers: 重新压缩时的线程数，默认为cpu核数
         '''
-
-        self.unzip(tmp_path)
-        if quiet:
-            os.system(f"cd {tmp_path} && zip -rq ./tmp.zip ./*")
-        else:
-            os.system(f"cd {tmp_path} && zip -r ./tmp.zip ./*")
-        
-        os.system(f"mv {os.path.join(tmp_path, 'tmp.zip')} {out_path}")
-
-        shutil.rmtree(tmp_path)
+        if args or tmp_path is not None or quiet is not None:
+            if len(args) > 2:
+                raise TypeError(f"re_zip() takes at most 3 positional arguments ({len(args) + 1} given)")
+            warnings.warn("re_zip(tmp_path, out_path, quiet) is deprecated, use re_zip(out_path), "
+                          "tmp_path and quiet are ignored", DeprecationWarning, stacklevel=2)
+            if args:    # 第一个参数是以前的tmp_path
+                out_path = args[0]
+        self.zip.re_zip(out_path, align, recompress, level, workers)
 
 
 
@@ -255,7 +485,7 @@ if __name__ == "__main__":
         # fw.write(apk.get_file(b"resources.arsc"))
 
     # print(apk.get_basic_info())
-    # apk.re_zip('./tmp_apk', './ttt.apk')
+    # apk.re_zip('./ttt.apk')
     # apk.unzip("/mnt/c/Users/user/Downloads/ttt/")
     # print(apk.get_app_name())
     
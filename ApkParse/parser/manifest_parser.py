@@ -0,0 +1,230 @@
+from typing import Dict, Iterable, List, Tuple, Union
+
+import logging
+
+from ApkParse.parser.res_parser import EVENT_START_ELEMENT, EVENT_END_ELEMENT
+
+logger = logging.getLogger("apk_parse")
+
+# http://schemas.android.com/apk/res/android 这个命名空间是固定死的
+ANDROID_NS = "{http://schemas.android.com/apk/res/android}"
+
+ACTION_MAIN = "android.intent.action.MAIN"
+CATEGORY_LAUNCHER = "android.intent.category.LAUNCHER"
+
+# application下的四大组件，activity-alias按activity处理
+COMPONENT_TAGS = {
+    "activity": "activity",
+    "activity-alias": "activity",
+    "service": "service",
+    "receiver": "receiver",
+    "provider": "provider",
+}
+
+
+def _get_attr(attrs:Dict[str, str], name:str) -> str:
+    '''
+    读取android命名空间下的属性，有的apk会抹掉命名空间，没有值(包括空字符串)时再按不带命名空间的名称找一次
+    '''
+    value = attrs.get(ANDROID_NS + name)
+    if not value:
+        value = attrs.get(name)
+    return value
+
+
+def _to_bool(value:str) -> Union[bool, None]:
+    '''
+    属性值解析后为"True"/"False"，其他值(如资源id)返回None
+    '''
+    if value == "True":
+        return True
+    if value == "False":
+        return False
+    return None
+
+
+class IntentFilter:
+    __slots__ = ("actions", "categories", "data", "priority")
+
+    def __init__(self, priority:str = None) -> None:
+        self.actions:List[str] = []
+        self.categories:List[str] = []
+        self.data:List[Dict[str, str]] = []     # <data>的属性，key为去掉命名空间的属性名，如scheme, host
+        self.priority:str = priority
+
+    def __repr__(self) -> str:
+        return f"<IntentFilter actions={self.actions} categories={self.categories}>"
+
+
+class Component:
+    __slots__ = ("kind", "tag", "name", "exported", "permission", "process", "enabled", "intent_filters", "line")
+
+    def __init__(self, kind:str, tag:str, attrs:Dict[str, str], line:int) -> None:
+        '''
+        Args:
+            kind: activity, service, receiver, provider
+            tag: manifest中的标签名，activity-alias的kind为activity
+            attrs: 节点的属性
+            line: 节点在源文件中的行号
+        '''
+        self.kind:str = kind
+        self.tag:str = tag
+        self.name:str = _get_attr(attrs, "name")
+        self.exported:Union[bool, None] = _to_bool(_get_attr(attrs, "exported"))  # 没有设置时为None
+        self.permission:str = _get_attr(attrs, "permission")
+        self.process:str = _get_attr(attrs, "process")
+        self.enabled:Union[bool, None] = _to_bool(_get_attr(attrs, "enabled"))
+        self.intent_filters:List[IntentFilter] = []
+        self.line:int = line
+
+    @property
+    def is_exported(self) -> bool:
+        '''
+        没有设置exported时，有intent-filter的组件默认导出(android 12之前的规则)
+        '''
+        if self.exported is None:
+            return len(self.intent_filters) > 0
+        return self.exported
+
+    def __repr__(self) -> str:
+        return f"<Component {self.kind} {self.name}>"
+
+
+class ManifestIndex:
+    '''
+    一次遍历manifest的事件，建立组件索引，可以按action, category直接查找组件
+    '''
+
+    def __init__(self, events:Iterable[Tuple[str, str, Union[Dict[str, str], str], int]]) -> None:
+        '''
+        Args:
+            events: Axml.iter_events()返回的事件
+        '''
+        self.package:str = ""
+        self.components:List[Component] = []
+        self.activities:List[Component] = []    # 包括activity-alias
+        self.services:List[Component] = []
+        self.receivers:List[Component] = []
+        self.providers:List[Component] = []
+        self.permissions:List[str] = []                 # uses-permission
+        self.declared_permissions:List[str] = []        # 自定义的permission
+        self.by_name:Dict[str, Component] = {}          # 重名时以第一个为准
+        self.by_action:Dict[str, List[Component]] = {}
+        self.by_category:Dict[str, List[Component]] = {}
+
+        by_kind = {
+            "activity": self.activities,
+            "service": self.services,
+            "receiver": self.receivers,
+            "provider": self.providers,
+        }
+        tags:List[str] = []                 # 当前路径上的标签名
+        component:Component = None          # 当前所在的组件
+        component_depth = 0
+        intent_filter:IntentFilter = None   # 当前所在的intent-filter
+        filter_depth = 0
+        for event, tag, attrs, line in events:
+            if event == EVENT_START_ELEMENT:
+                tags.append(tag)
+                depth = len(tags)
+                if depth == 1:
+                    if tag == "manifest":
+                        self.package = attrs.get("package", "")
+                elif depth == 2:
+                    if tag == "uses-permission" or tag == "uses-permission-sdk-23":
+                        self._add_name(self.permissions, attrs)
+                    elif tag == "permission":
+                        self._add_name(self.declared_permissions, attrs)
+                elif depth == 3 and tags[1] == "application" and tag in COMPONENT_TAGS:
+                    component = Component(COMPONENT_TAGS[tag], tag, attrs, line)
+                    component_depth = depth
+                    self.components.append(component)
+                    by_kind[component.kind].append(component)
+                    if component.name is not None:
+                        self.by_name.setdefault(component.name, component)
+                elif component is not None and depth == component_depth + 1 and tag == "intent-filter":
+                    intent_filter = IntentFilter(_get_attr(attrs, "priority"))
+                    filter_depth = depth
+                    component.intent_filters.append(intent_filter)
+                elif intent_filter is not None and depth == filter_depth + 1:
+                    self._add_filter_item(component, intent_filter, tag, attrs)
+
+            elif event == EVENT_END_ELEMENT:
+                depth = len(tags)
+                if tags:
+                    tags.pop()
+                if intent_filter is not None and depth == filter_depth:
+                    intent_filter = None
+                elif component is not None and depth == component_depth:
+                    component = None
+
+    @staticmethod
+    def _add_name(names:List[str], attrs:Dict[str, str]) -> None:
+        name = _get_attr(attrs, "name")
+        if name is not None:
+            names.append(name)
+
+    def _add_filter_item(self, component:Component, intent_filter:IntentFilter, tag:str, attrs:Dict[str, str]) -> None:
+        '''
+        intent-filter下的action, category, data
+        '''
+        if tag == "action" or tag == "category":
+            name = _get_attr(attrs, "name")
+            if name is None:
+                return
+            if tag == "action":
+                intent_filter.actions.append(name)
+                index = self.by_action
+            else:
+                intent_filter.categories.append(name)
+                index = self.by_category
+            components = index.setdefault(name, [])
+            if not components or components[-1] is not component:    # 同一个组件只记录一次
+                components.append(component)
+        elif tag == "data":
+            intent_filter.data.append({key.rsplit("}", 1)[-1]: value for key, value in attrs.items()})
+
+    def find(self, action:str = None, category:str = None, kind:str = None,
+             exported:bool = None) -> List[Component]:
+        '''
+        查找组件，各条件同时满足，如: find(action="android.intent.action.BOOT_COMPLETED", kind="receiver", exported=True)
+
+        Args:
+            action: intent-filter中包含此action
+            category: intent-filter中包含此category
+            kind: activity, service, receiver, provider
+            exported: 是否导出(按is_exported判断)
+        '''
+        if action is not None:
+            components = self.by_action.get(action, [])
+        elif category is not None:
+            components = self.by_category.get(category, [])
+        else:
+            components = self.components
+        # action和category同时指定时，用category的结果过滤
+        category_ids = None
+        if action is not None and category is not None:
+            category_ids = {id(component) for component in self.by_category.get(category, [])}
+
+        res = []
+        for component in components:
+            if category_ids is not None and id(component) not in category_ids:
+                continue
+            if kind is not None and component.kind != kind:
+                continue
+            if exported is not None and component.is_exported != exported:
+                continue
+            res.append(component)
+        return res
+
+    def get_main_activity(self) -> Union[str, None]:
+        '''
+        第一个同一个intent-filter中包含MAIN和LAUNCHER的activity(不包括activity-alias)，没有时返回None
+        '''
+        for component in self.by_action.get(ACTION_MAIN, []):
+            if component.tag != "activity":
+                continue
+            for intent_filter in component.intent_filters:
+                if ACTION_MAIN in intent_filter.actions and CATEGORY_LAUNCHER in intent_filter.categories:
+                    return component.name
+        return None
@@ -0,0 +1,241 @@
+from collections import OrderedDict
+import mmap
+import os
+import threading
+from typing import Dict, List, Tuple
+
+import logging
+logger = logging.getLogger("apk_parse")
+
+BLOCK_SIZE = 64 * 1024
+CACHE_SIZE = 32 * 1024 * 1024
+
+
+class RangeReader:
+    '''
+    随机读取接口，ZipFile通过它读取数据，可以自己实现从任意位置(如对象存储)按范围读取
+
+    子类只需要实现 _read() 和 size，统计数据(requests, bytes_read)由基类负责
+    '''
+    # read()返回的是否为原始数据上的视图(不产生复制和IO)，为True时ZipFile不做预读和缓存
+    zero_copy:bool = False
+
+    def __init__(self) -> None:
+        self.size:int = 0
+        self.requests:int = 0       # 读取请求次数
+        self.bytes_read:int = 0     # 读取的总字节数
+        self._stat_lock = threading.Lock()
+
+    def read(self, offset:int, length:int) -> bytes:
+        '''
+        读取[offset, offset + length)的数据，超出文件末尾时返回的数据会变短
+        '''
+        if offset < 0 or length < 0:
+            raise ValueError(f"invalid range: {offset}, {length}")
+        length = max(0, min(length, self.size - offset))
+        data = self._read(offset, length)
+        with self._stat_lock:
+            self.requests += 1
+            self.bytes_read += len(data)
+        return data
+
+    def read_ranges(self, ranges:List[Tuple[int, int]], max_gap:int = 0) -> List[Tuple[int, bytes]]:
+        '''
+        合并相邻(间隔不超过max_gap)的范围后再读取，减少请求次数
+
+        return:
+            [(offset, data), ...] 合并后每个范围的起始位置和数据
+        '''
+        res = []
+        for start, end in merge_ranges(ranges, max_gap):
+            res.append((start, self.read(start, end - start)))
+        return res
+
+    def _read(self, offset:int, length:int) -> bytes:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> "RangeReader":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+
+def merge_ranges(ranges:List[Tuple[int, int]], max_gap:int = 0) -> List[Tuple[int, int]]:
+    '''
+    合并重叠或间隔不超过max_gap的范围
+
+    Args:
+        ranges: [(offset, length), ...]
+    return:
+        [(start, end), ...]
+    '''
+    merged = []
+    for start, length in sorted(ranges):
+        end = start + length
+        if merged and start <= merged[-1][1] + max_gap:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return [(start, end) for start, end in merged]
+
+
+class BytesRangeReader(RangeReader):
+    '''
+    从内存中的bytes读取，返回的是memoryview，不复制数据
+    '''
+    zero_copy = True
+
+    def __init__(self, data:bytes) -> None:
+        super().__init__()
+        self._data = memoryview(data)
+        self.size = len(data)
+
+    def _read(self, offset:int, length:int) -> memoryview:
+        return self._data[offset: offset + length]
+
+    def close(self) -> None:
+        self._data = memoryview(b"")
+
+
+class MmapRangeReader(RangeReader):
+    '''
+    mmap映射本地文件，返回的是mmap上的memoryview，只有实际访问到的页会占用内存
+    '''
+    zero_copy = True
+
+    def __init__(self, fpath:str) -> None:
+        super().__init__()
+        self.path = fpath
+        self._mmap:mmap.mmap = None
+        with open(fpath, 'rb') as fpin:
+            self.size = os.fstat(fpin.fileno()).st_size
+            if self.size > 0:   # 空文件无法mmap
+                self._mmap = mmap.mmap(fpin.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap) if self._mmap is not None else memoryview(b"")
+
+    @property
+    def mmap(self) -> mmap.mmap:
+        return self._mmap
+
+    def _read(self, offset:int, length:int) -> memoryview:
+        return self._view[offset: offset + length]
+
+    def close(self) -> None:
+        if self._mmap is None:
+            return
+        try:
+            self._view.release()
+            self._mmap.close()
+        except BufferError:
+            # 外部还持有memoryview时无法关闭，交给gc处理
+            logger.warning("MmapRangeReader close: mmap is still in use")
+        self._view = memoryview(b"")
+        self._mmap = None
+
+
+class FileRangeReader(RangeReader):
+    '''
+    用pread读取本地文件，每次读取都会产生一次IO，可以多线程使用
+    '''
+
+    def __init__(self, fpath:str) -> None:
+        super().__init__()
+        self.path = fpath
+        self._fpin = open(fpath, 'rb')
+        self.size = os.fstat(self._fpin.fileno()).st_size
+        self._lock = threading.Lock()
+
+    def _read(self, offset:int, length:int) -> bytes:
+        if hasattr(os, "pread"):
+            return os.pread(self._fpin.fileno(), length, offset)
+        with self._lock:    # windows没有pread
+            self._fpin.seek(offset)
+            return self._fpin.read(length)
+
+    def close(self) -> None:
+        self._fpin.close()
+
+
+class CachedRangeReader(RangeReader):
+    '''
+    按块缓存另一个RangeReader读取的数据，总大小超过max_bytes时淘汰最久没有使用的块(LRU)
+
+    连续缺失的块合并成一次读取，一次读取的块总大小超过max_bytes时直接读取，不进入缓存；
+    hits, misses按块统计，evictions为淘汰的块数
+    '''
+
+    def __init__(self, reader:RangeReader, max_bytes:int = CACHE_SIZE, block_size:int = BLOCK_SIZE) -> None:
+        super().__init__()
+        self.reader = reader
+        self.path = getattr(reader, "path", "")
+        self.size = reader.size
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.hits:int = 0
+        self.misses:int = 0
+        self.evictions:int = 0
+        self.cached_bytes:int = 0
+        self._blocks:Dict[int, bytes] = OrderedDict()   # 块序号 -> 数据
+        self._lock = threading.Lock()
+
+    def _read(self, offset:int, length:int) -> bytes:
+        if length == 0:
+            return b""
+        first = offset // self.block_size
+        last = (offset + length - 1) // self.block_size
+        if (last - first + 1) * self.block_size > self.max_bytes:
+            with self._lock:
+                self.misses += last - first + 1
+            return self.reader.read(offset, length)
+
+        with self._lock:
+            blocks = [self._blocks.get(i) for i in range(first, last + 1)]
+            for i, block in enumerate(blocks, first):
+                if block is not None:
+                    self._blocks.move_to_end(i)
+            missing = [i for i, block in enumerate(blocks, first) if block is None]
+            self.hits += len(blocks) - len(missing)
+            self.misses += len(missing)
+
+        # 读取时不加锁，多个线程同时读取同一个块时只是多读一次
+        loaded = {}
+        for start, end in merge_ranges([(i, 1) for i in missing]):
+            data = self.reader.read(start * self.block_size, (end - start) * self.block_size)
+            for i in range(start, end):
+                pos = (i - start) * self.block_size
+                loaded[i] = bytes(data[pos: pos + self.block_size])
+        if loaded:
+            self._insert(loaded)
+            blocks = [loaded[i] if block is None else block for i, block in enumerate(blocks, first)]
+
+        start = offset - first * self.block_size
+        if len(blocks) == 1:
+            return memoryview(blocks[0])[start: start + length]
+        return b"".join(blocks)[start: start + length]
+
+    def _insert(self, loaded:Dict[int, bytes]) -> None:
+        with self._lock:
+            for i, block in loaded.items():
+                old = self._blocks.pop(i, None)
+                if old is not None:
+                    self.cached_bytes -= len(old)
+                self._blocks[i] = block
+                self.cached_bytes += len(block)
+            while self.cached_bytes > self.max_bytes:
+                _, block = self._blocks.popitem(last=False)
+                self.cached_bytes -= len(block)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._blocks.clear()
+            self.cached_bytes = 0
+
+    def close(self) -> None:
+        self.clear()
+        self.reader.close()
@@ -1,7 +1,13 @@
+from array import array
+from bisect import bisect_right
+import codecs
+from collections import OrderedDict
+import io
+from operator import add
+import re
 import struct
-from typing import Dict, List, Tuple, Union
-from lxml import etree
-from xml.etree.ElementTree import Element   #这个用于开启代码提示
+import sys
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
 import logging
 # from memory_profiler import profile
 
@@ -73,8 +79,34 @@ RES_VALUE_SIZE                  = 0x08      # ResValue结构体的大小
 RES_TABLE_PACKAGE_HEADER_SIZE   = 0x120     # ResTablePackage的头部大小
 RES_TABLE_TYPE_SPEC_SIZE        = 0x10      # ResTypeSpec的基本大小
 RES_TABLE_TYPE_SIZE             = 0x14      # ResTableType的基本大小
+RES_XML_TREE_ATTRIBUTE_SIZE     = 0x14      # AxmlAttribute结构体的大小
 ############ size end
 
+############ 预编译的struct，大量重复解析的结构直接用unpack_from从原始数据中读取，不做切片
+CHUNK_HEADER_STRUCT = struct.Struct("<HHI")         # ResChunkHeader
+XML_NODE_STRUCT = struct.Struct("<2I")              # xml节点的行号和注释
+XML_ATTR_EXT_STRUCT = struct.Struct("<2I6H")        # StartElement的属性描述信息
+XML_END_ELEMENT_STRUCT = struct.Struct("<2I")       # EndElement的ns和name
+XML_ATTRIBUTE_STRUCT = struct.Struct("<3I")         # AxmlAttribute的ns, name, raw_value
+RES_VALUE_STRUCT = struct.Struct("<H2BI")           # ResValue
+XML_ATTRIBUTE_VALUE_STRUCT = struct.Struct("<3IH2BI")   # AxmlAttribute和其中的ResValue
+############ struct end
+
+############ Axml.iter_events()返回的事件类型
+EVENT_START_NS      = "start-ns"
+EVENT_END_NS        = "end-ns"
+EVENT_START_ELEMENT = "start"
+EVENT_END_ELEMENT   = "end"
+EVENT_CDATA         = "cdata"
+############ event end
+
+############ Axml.write_xml()使用
+XML_DECLARATION = "<?xml version='1.0' encoding='utf-8'?>\n"
+INVALID_XML_CHARS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]")   # xml 1.0中不允许出现的字符
+XML_NAME = re.compile(r"[^\W\d][\w.\-]*\Z")       # 合法的属性名(不含命名空间)
+WRITE_BUFFER_COUNT = 1024       # 缓存的片段数达到此值时写入一次
+############
+
 ############ android官方资源中的，各个types对应的数值，没用到，先放着
 RES_TYPES = {  
     0x01: "attr",
@@ -110,7 +142,7 @@ class ResChunkHeader:
         if len(buff) - offset >= RES_CHUNK_HEADER_SIZE:
             (self.res_type,
             self.header_size,
-            self.size) = struct.unpack("<HHI", buff[offset: offset + RES_CHUNK_HEADER_SIZE])
+            self.size) = CHUNK_HEADER_STRUCT.unpack_from(buff, offset)
 
             if len(buff) - offset < self.size:
                 raise Exception(f"Chunk length error, except {self.size}, got {len(buff)}")
@@ -143,51 +175,192 @@ class ResChunkHeader:
 SORTED_FLAG = 1 << 0
 UTF8_FLAG = 1 << 8
 
+STRING_CACHE_SIZE = 16384   # 字符串池缓存的最大字符串数，超过时淘汰最早解码的
+STRING_DECODE_BLOCK = 1024  # list_strings()中一次解码的字符串数
+
+# 宽松的utf-8: lead byte决定字节数(允许5、6字节的形式)，continuation byte不做校验，(mask, flag, 字节数)
+UTF8_LEAD_BYTES = ((0xE0, 0xC0, 2), (0xF0, 0xE0, 3), (0xF8, 0xF0, 4), (0xFC, 0xF8, 5), (0xFE, 0xFC, 6))
+UTF8_RECOVER_ERRORS = "apk_parse.utf8_recover"     # 注册的codec错误处理函数名
+
+
+def _utf8_code_point(data:bytes, pos:int) -> Tuple[int, int]:
+    '''
+    按宽松的utf-8规则解出pos处的一个编号，返回(编号, 字节数)
+    '''
+    lead = data[pos]
+    if lead & 0x80 == 0:
+        return lead, 1
+    for mask, flag, size in UTF8_LEAD_BYTES:
+        if lead & mask == flag:
+            break
+    else:
+        raise Exception(f"decode utf-8 error, invalid lead byte {lead:#x} at {pos}, bytes:{data}")
+    if pos + size > len(data):
+        raise Exception(f"decode utf-8 error, truncated sequence at {pos}, bytes:{data}")
+    value = lead & (0x7F >> size)
+    for b in data[pos + 1: pos + size]:
+        value = (value << 6) | (b & 0x3F)
+    return value, size
+
+
+def _utf8_recover(exc:UnicodeError) -> Tuple[str, int]:
+    '''
+    codec错误处理函数，python的utf-8解码器不接受的序列(modified utf-8的C0 80、超长编码、5、6字节的形式等)按宽松的规则解码
+    '''
+    if not isinstance(exc, UnicodeDecodeError):
+        raise exc
+    data = exc.object
+    value, size = _utf8_code_point(data, exc.start)
+    end = exc.start + size
+    if value <= 0x10FFFF:
+        return chr(value), end
+    # 超出unicode范围的编号，只有作为高位代理且后面不是低位代理时会被丢弃，其他情况都无法解码
+    if value & 0xFC00 == 0xD800 and end < len(data) and _utf8_code_point(data, end)[0] & 0xFC00 != 0xDC00:
+        return "", end
+    raise Exception(f"decode utf-8 error, invalid code point {value:#x} at {exc.start}, bytes:{data}")
+
+codecs.register_error(UTF8_RECOVER_ERRORS, _utf8_recover)
+
+
+# 可能需要处理的字符: 代理和补充平面的字符(编号只看低16位，补充平面中也有"代理")
+SURROGATE_CANDIDATE = re.compile("[\ud800-\udfff\U00010000-\U0010ffff]")
+
+
+def _join_surrogates(text:str) -> str:
+    '''
+    高位代理和后面的低位代理合成一个字符，后面不是低位代理时丢弃高位代理，规则和原来逐个编号处理时一致
+    '''
+    pieces = []
+    pos = 0
+    for match in SURROGATE_CANDIDATE.finditer(text):
+        index = match.start()
+        if index < pos:     # 已经作为低位代理合并了
+            continue
+        high = ord(text[index])
+        if high & 0xFC00 != 0xD800:
+            continue
+        if index + 1 == len(text):
+            raise Exception(f"decode utf-8 error, unpaired surrogate at end: {text!r}")
+        pieces.append(text[pos: index])
+        pos = index + 1
+        low = ord(text[pos])
+        if low & 0xFC00 == 0xDC00:
+            if high > 0xFFFF or low > 0xFFFF:
+                raise Exception(f"decode utf-8 error, invalid surrogate pair: {high:#x} {low:#x}")
+            pieces.append(chr(0x10000 + ((high - 0xD800) << 10) + (low - 0xDC00)))
+            pos += 1
+    if not pieces:
+        return text
+    pieces.append(text[pos:])
+    return "".join(pieces)
+
+class StringTable:
+    '''
+    字符串驻留表，相同的字符串只保存一份，用序号引用
+
+    Arsc的全局字符串池和各个package的类型、资源名字符串池共用一个，
+    各个语言配置中的同名资源都引用同一个资源名字符串
+    '''
+
+    def __init__(self) -> None:
+        self.strings:List[str] = []
+        self.ids:Dict[str, int] = {}
+
+    def intern(self, string:str) -> int:
+        '''
+        返回字符串的序号，第一次出现时加入表中
+        '''
+        string_id = self.ids.get(string)
+        if string_id is None:
+            string_id = self.ids[string] = len(self.strings)
+            self.strings.append(string)
+        return string_id
+
+    def share(self, string:str) -> str:
+        '''
+        表中已有相同的字符串时返回表中的字符串，否则原样返回，不加入表
+        '''
+        string_id = self.ids.get(string)
+        if string_id is None:
+            return string
+        return self.strings[string_id]
+
+    def __getitem__(self, string_id:int) -> str:
+        return self.strings[string_id]
+
+    def __len__(self) -> int:
+        return len(self.strings)
+
+
 class StringPool(ResChunkHeader):
-    def __init__(self, buff: bytes, pre_decode:bool = True) -> None:
+    def __init__(self, buff: bytes, pre_decode:bool = False, offset:int = 0, cache_size:int = STRING_CACHE_SIZE,
+                 table:StringTable = None) -> None:
         '''
-        解析字符串池
+        解析字符串池，字符串在第一次使用时才解码，解码结果缓存在self.strings中
+
+        arsc的全局字符串池可能有十几万个字符串，而一般只会用到其中很少一部分，
+        所以默认不预先解码，偏移表保存为array('I')，不创建大量的int对象，内存占用和实际用到的字符串数相关
 
         Args:
-            buff: bytes buffer
-            pre_decode: 在__init__函数中解析全部的字符串, 默认开启, 
-                有特殊需求时(如只需要提取apk中某个已知id的字符串时)关闭可以提升一点效率
+            buff: bytes buffer，可以是整个文件，字符串池从offset开始，不需要切片复制
+            pre_decode: 在__init__函数中解析全部的字符串，并且全部缓存(不受cache_size限制)，
+                需要全部字符串时建议用list_strings()
+            offset: 字符串池在buff中的起始位置
+            cache_size: 最多缓存的字符串数，为None时不限制
+            table: 字符串驻留表，cache_size为None时解码结果都存入table，只记录 字符串序号->table中的序号；
+                否则仍使用缓存，只复用table中已有的字符串，不加入table，避免大的字符串池用过的字符串一直占用内存
         '''
-        super().__init__(buff)
+        super().__init__(buff, offset)
+        self.offset = offset
         if self.header_size != STRING_POOL_HEADER_SIZE:
             # raise Exception("AXML: String pool header length error")
             logger.error("AXML: String pool header length error")
             pass
-        
-        header_buff = self.buff[RES_CHUNK_HEADER_SIZE: STRING_POOL_HEADER_SIZE]
 
         (self.string_cnt,
         self.style_cnt,
         self.flag,
         self.string_offset,
-        self.style_offset) = struct.unpack("<5I", header_buff)
+        self.style_offset) = struct.unpack_from("<5I", self.buff, offset + RES_CHUNK_HEADER_SIZE)
         self.is_utf8 = ((self.flag & UTF8_FLAG) != 0)
         logger.debug(f"StringPool: cnt--{self.string_cnt}, is utf-8? {self.is_utf8}")
 
-        self.string_offsets:List[int] = []
-        self.style_offsets:List[int] = []
-        if self.string_cnt > 0:
-            self.string_offsets:List[int] = list(struct.unpack(f"<{self.string_cnt}I", 
-                        self.buff[self.header_size: self.header_size + 4*self.string_cnt]))
-        if self.style_cnt > 0:
-            self.style_offsets:List[int] = list(struct.unpack(f"<{self.style_cnt}I", 
-                        self.buff[self.header_size + 4*self.string_cnt: self.header_size + 4*self.string_cnt + 4*self.style_cnt]))
-        
-        self.strings:Dict[int, str] = {}
-        self.styles:Dict[int, str] = {}
-
-        if pre_decode:
+        # 偏移表直接从buff复制为array，每项只占4字节
+        index = offset + self.header_size
+        self.string_offsets:array = self._read_offsets(index, self.string_cnt)
+        self.style_offsets:array = self._read_offsets(index + 4*self.string_cnt, self.style_cnt)
+
+        self.cache_size = None if pre_decode else cache_size
+        self.strings:Dict[int, str] = OrderedDict()
+        self.styles:Dict[int, str] = OrderedDict()
+        self.table = table
+        self.string_ids:Dict[int, int] = {}     # 使用table时的缓存，字符串序号 -> table中的序号
+        # search()使用，第一次查找时生成：排序后的字符串偏移和对应的字符串序号
+        self._sorted_offsets:array = None
+        self._offset_order:array = None
+
+        if pre_decode and table is not None:    # cache_size为None，全部存入table
+            for i in range(self.string_cnt):
+                self.get_string(i)
+        elif pre_decode:
             for i in range(self.string_cnt):
                 self.strings[i] = self.string_at(self.string_offset + self.string_offsets[i])
             # TODO. 完善style解析，但是这个东西逆向应该没啥价值
             # for i in range(self.style_cnt):
             #     self.styles[i] = self.string_at(self.style_offset + self.style_offsets[i])
 
+    def _read_offsets(self, index:int, count:int) -> array:
+        '''
+        读取count个uint32的偏移，超出buff的部分忽略
+        '''
+        offsets = array('I')
+        if count > 0:
+            end = min(index + 4*count, len(self.buff))
+            offsets.frombytes(self.buff[index: end - (end - index) % 4])
+            if sys.byteorder == "big":
+                offsets.byteswap()
+        return offsets
+
     def get_string(self, num:int) -> str:
         '''
         通过字符串序号(id)获取字符串, 传入值必须大于0
@@ -195,14 +368,22 @@ class StringPool(ResChunkHeader):
         if num > self.string_cnt or num < 0:
             logger.warning(f"AXML: Invalid String id number, {hex(num)}")
             return ""
+        if self.table is not None and self.cache_size is None:
+            string_id = self.string_ids.get(num)
+            if string_id is None:
+                string_id = self.string_ids[num] = self.table.intern(self.string_at(self.string_offset + self.string_offsets[num]))
+            return self.table.strings[string_id]
         try:
             return self.strings[num]
         except:
             pass
 
         index = self.string_offset + self.string_offsets[num]
-        self.strings[num] = self.string_at(index)
-        return self.strings[num]
+        string = self.string_at(index)
+        if self.table is not None:
+            string = self.table.share(string)
+        self._cache(self.strings, num, string)
+        return string
 
     def get_style(self, num:int) -> str:
         '''
@@ -216,17 +397,250 @@ class StringPool(ResChunkHeader):
             pass
 
         index = self.style_offset + self.style_offsets[num]
-        self.styles[num] = self.string_at(index)
-        return self.styles[num]
+        string = self.string_at(index)
+        self._cache(self.styles, num, string)
+        return string
+
+    def _cache(self, cache:Dict[int, str], num:int, string:str) -> None:
+        '''
+        缓存解码结果，超过cache_size时淘汰最早加入的
+        '''
+        if self.cache_size is not None and len(cache) >= self.cache_size:
+            cache.popitem(last=False)
+        cache[num] = string
+
+    def list_strings(self) -> List[str]:
+        '''
+        按序号返回全部字符串，结果不进入缓存，和逐个调用get_string()的结果一致
+        '''
+        strings = self._decode_region()
+        if strings is None:
+            strings = self._decode_blocks()
+        return strings
+
+    def search(self, pattern:Union[str, bytes, re.Pattern]) -> List[Tuple[int, str]]:
+        '''
+        在字符串池的原始数据中查找，不解码全部字符串，只解码匹配到的
+
+        Args:
+            pattern: str按字面量查找，先编码为字符串池的编码(utf-8或utf-16-le)；
+                bytes或编译好的bytes正则直接在原始数据上匹配，utf-16的字符串池需要按utf-16-le编写
+        return:
+            [(字符串序号, 字符串), ...] 按序号排序，匹配必须在一个字符串的数据内
+        '''
+        return self.search_many([pattern])[pattern]
+
+    def search_many(self, patterns:Iterable[Union[str, bytes, re.Pattern]]) -> Dict[Union[str, bytes, re.Pattern], List[Tuple[int, str]]]:
+        '''
+        依次查找多个pattern，共用偏移索引和解码结果
+
+        return:
+            {pattern: [(字符串序号, 字符串), ...], ...}
+        '''
+        res = {}
+        for pattern in patterns:
+            if pattern not in res:
+                res[pattern] = [(num, self.get_string(num)) for num in self._search_raw(self._compile_pattern(pattern))]
+        return res
+
+    def _compile_pattern(self, pattern:Union[str, bytes, re.Pattern]) -> re.Pattern:
+        if isinstance(pattern, str):
+            return re.compile(re.escape(pattern.encode("utf-8" if self.is_utf8 else "utf-16-le")))
+        if isinstance(pattern, bytes):
+            return re.compile(pattern)
+        if not isinstance(pattern.pattern, bytes):
+            raise Exception(f"StringPool search: need a bytes pattern, got {pattern}")
+        return pattern
+
+    def _search_raw(self, pattern:re.Pattern) -> List[int]:
+        '''
+        返回匹配到的字符串序号，匹配位置用bisect在排序后的偏移中找到所在的字符串
+        '''
+        if self._sorted_offsets is None:
+            offsets = self.string_offsets[:self.string_cnt]
+            self._sorted_offsets = array('I', sorted(offsets))
+            if self._sorted_offsets == offsets:     # 一般偏移本来就是递增的
+                self._offset_order = array('I', range(len(offsets)))
+            else:
+                self._offset_order = array('I', sorted(range(len(offsets)), key=offsets.__getitem__))
+        offsets = self._sorted_offsets
+        buff = self.buff
+        base = self.offset + self.string_offset
+        end = min(self.offset + self.size, len(buff))
+        res = set()
+        pos = base
+        while pos <= end:
+            match = pattern.search(buff, pos, end)
+            if match is None:
+                break
+            start = match.start()
+            pos = start + 1
+            i = bisect_right(offsets, start - base) - 1
+            if i < 0:
+                continue
+            try:
+                data_start, data_end = self._payload_range(base + offsets[i])
+            except Exception:
+                continue
+            # 在长度、结尾的0或者对齐的空白中，空字符串的数据长度为0，也在这里跳过
+            if start < data_start or start >= data_end:
+                continue
+            # 匹配不能超出这个字符串的数据，utf-16的匹配需要按字符对齐
+            match = pattern.search(buff, start, data_end)
+            while match is not None and not self.is_utf8 and (match.start() - data_start) & 1:
+                match = pattern.search(buff, match.start() + 1, data_end)
+            if match is not None and match.end() <= data_end:
+                # 多个字符串可能共用同一份数据
+                offset = offsets[i]
+                while i >= 0 and offsets[i] == offset:
+                    res.add(self._offset_order[i])
+                    i -= 1
+            # 这个字符串中后面的位置已经查找过，从下一个字符串继续
+            pos = max(pos, data_end)
+        return sorted(res)
+
+    def _payload_range(self, index:int) -> Tuple[int, int]:
+        '''
+        index(在buff中的位置)处字符串的数据(不含长度和结尾的0)在buff中的范围
+        '''
+        if self.is_utf8:
+            _, skip = self._decode_length(index, 1)
+            index += skip
+            length, skip = self._decode_length(index, 1)
+        else:
+            length, skip = self._decode_length(index, 2)
+            length *= 2
+        index += skip
+        return index, index + length
+
+    def _decode_region(self) -> Union[List[str], None]:
+        '''
+        把整个字符串池的数据区一次解码，再按偏移直接切片
+
+        只有字符位置和数据偏移一一对应时可用：utf-16中没有代理对(偏移除以2就是字符位置)，utf-8中全部是ascii；
+        长度占2字节、读取越界、有BOM等需要特殊处理的情况返回None
+        '''
+        count = min(self.string_cnt, len(self.string_offsets))
+        if count == 0:
+            return []
+        offsets = self.string_offsets[:count]
+        region = self.buff[self.offset + self.string_offset: self.offset + self.size]
+        if self.is_utf8:
+            if not region.isascii():
+                return None
+            text = region.decode("ascii")
+            positions = offsets.tolist()
+            # 和_decode_length一样，每个长度读取2字节
+            if max(positions) + 3 > len(text):
+                return None
+            # [utf-16长度][utf-8字节数][数据]，ascii的长度都只占1字节
+            lengths = list(map(ord, map(text.__getitem__, map((1).__add__, positions))))
+            skip = 2
+        else:
+            if 1 in map((1).__and__, offsets):
+                return None
+            try:
+                text = region.decode("utf-16-le")
+            except UnicodeDecodeError:
+                return None
+            # 逐个解码时使用"utf-16"，开头的BOM会被去掉或者切换字节序
+            if len(text) * 2 != len(region) or "\ufeff" in text or "\ufffe" in text:
+                return None
+            positions = [offset >> 1 for offset in offsets]
+            # 长度读取4字节
+            if max(positions) + 2 > len(text):
+                return None
+            lengths = list(map(ord, map(text.__getitem__, positions)))
+            if max(lengths) & 0x8000:   # 长度占2个字符
+                return None
+            skip = 1
+        if max(map(add, positions, lengths)) + skip > len(text):   # 数据超出字符串池
+            return None
+        return [text[pos + skip: pos + skip + length] for pos, length in zip(positions, lengths)]
+
+    def _decode_blocks(self) -> List[str]:
+        '''
+        每STRING_DECODE_BLOCK个字符串用"\x00"连接起来一次解码后分割，
+        某一块解码出错或者有需要特殊处理的字符串时，只对这一块逐个解码
+        '''
+        payloads = self._read_payloads()
+        res = []
+        for i in range(0, len(payloads), STRING_DECODE_BLOCK):
+            block = payloads[i: i + STRING_DECODE_BLOCK]
+            strings = self._decode_block(block)
+            if strings is None:
+                strings = [self._decode_payload(num, payload) for num, payload in enumerate(block, i)]
+            res.extend(strings)
+        return res
+
+    def _read_payloads(self) -> List[Union[bytes, None]]:
+        '''
+        每个字符串的数据(不含长度和结尾的0)，长度占2字节(utf-16为2个字符)或者读取越界的为None
+        '''
+        buff = self.buff
+        base = self.offset + self.string_offset
+        count = min(self.string_cnt, len(self.string_offsets))
+        offsets = self.string_offsets[:count]
+        # 和_decode_length一样，utf-8的两个长度各读取2字节，utf-16的长度读取4字节，全部不越界时才能一次读取
+        if count == 0 or max(offsets) + base + 4 > len(buff):
+            return [None] * count
+        if self.is_utf8:
+            return [buff[ptr + 2: ptr + 2 + buff[ptr + 1]] if buff[ptr] < 0x80 and buff[ptr + 1] < 0x80 else None
+                    for ptr in map(base.__add__, offsets)]
+        return [buff[ptr + 2: ptr + 2 + ((buff[ptr] | (buff[ptr + 1] << 8)) << 1)] if buff[ptr + 1] < 0x80 else None
+                for ptr in map(base.__add__, offsets)]
+
+    def _decode_block(self, block:List[Union[bytes, None]]) -> Union[List[str], None]:
+        '''
+        把多个字符串连接起来一次解码，结果可能和逐个解码不一致时返回None
+        '''
+        if None in block:
+            return None
+        try:
+            if self.is_utf8:
+                text = b"\x00".join(block).decode("utf-8")
+                # 本身包含U+FFFD的字符串逐个解码时会进入_my_utf8_decode
+                if "\ufffd" in text:
+                    return None
+            else:
+                text = b"\x00\x00".join(block).decode("utf-16-le")
+                if "\ufeff" in text or "\ufffe" in text:
+                    return None
+        except UnicodeDecodeError:
+            return None
+        strings = text.split("\x00")
+        if len(strings) != len(block):     # 字符串本身包含"\x00"
+            return None
+        return strings
+
+    def _decode_payload(self, num:int, payload:Union[bytes, None]) -> str:
+        '''
+        逐个解码一个字符串，出错时和string_at()一样返回空字符串
+        '''
+        if payload is None:
+            return self.string_at(self.string_offset + self.string_offsets[num])
+        if self.is_utf8:
+            try:
+                return self._decode_utf8_data(payload)
+            except Exception as e:
+                logger.warning(f"decode utf-8 string error: {str(e)}")
+                return ""
+        else:
+            try:
+                return payload.decode("utf-16")
+            except Exception as e:
+                logger.warning(f"decode utf-16 string error: {str(e)}")
+                return ""
 
     def string_at(self, index:int) -> str:
         '''
-        从index开始解析一个字符串
+        从index(相对于字符串池的起始位置)开始解析一个字符串
 
         如果出错，返回空字符串
 
         出错一般是apk进行了对抗, 插入了错误字符串, 而实际上在app运行过程中不会使用此错误字符串
         '''
+        index += self.offset
         if self.is_utf8:
             try:
                 return self._decode_utf8(index)
@@ -243,74 +657,15 @@ class StringPool(ResChunkHeader):
     def _my_utf8_decode(self, data:bytes) -> str:
         """
         utf-8解码, 返回解析出来的字符串
-        """
-        res = []
 
-        data_ptr = 0
-        while (data_ptr < len(data)):
-            tmp_b:int = 0
-
-            if data[data_ptr] & 0x80 == 0:   # 单字节
-                res.append(data[data_ptr] & 0x7f)
-                data_ptr += 1
-            elif data[data_ptr] & 0xE0 == 0xC0:
-                tmp_b += (data[data_ptr] & 0x1F) << 6
-                tmp_b += (data[data_ptr + 1] & 0x3F)
-                res.append(tmp_b)
-                data_ptr += 2
-            elif data[data_ptr] & 0xF0 == 0xE0:
-                tmp_b += (data[data_ptr] & 0xF) << 6*2
-                tmp_b += (data[data_ptr + 1] & 0x3F) << 6
-                tmp_b += (data[data_ptr + 2] & 0x3F)
-                res.append(tmp_b)
-                data_ptr += 3
-            elif data[data_ptr] & 0xF8 == 0xF0:
-                tmp_b += (data[data_ptr] & 0x7) << 6*3
-                tmp_b += (data[data_ptr + 1] & 0x3F) << 6*2
-                tmp_b += (data[data_ptr + 2] & 0x3F) << 6
-                tmp_b += (data[data_ptr + 3] & 0x3F)
-                res.append(tmp_b)
-                data_ptr += 4
-            elif data[data_ptr] & 0xFC == 0xF8:
-                tmp_b += (data[data_ptr] & 0x3) << 6*4
-                tmp_b += (data[data_ptr + 1] & 0x3F) << 6*3
-                tmp_b += (data[data_ptr + 2] & 0x3F) << 6*2
-                tmp_b += (data[data_ptr + 3] & 0x3F) << 6
-                tmp_b += (data[data_ptr + 4] & 0x3F)
-                res.append(tmp_b)
-                data_ptr += 5
-            elif data[data_ptr] & 0xFE == 0xFC:
-                tmp_b += (data[data_ptr] & 0x1) << 6*5
-                tmp_b += (data[data_ptr + 1] & 0x3F) << 6*4
-                tmp_b += (data[data_ptr + 2] & 0x3F) << 6*3
-                tmp_b += (data[data_ptr + 3] & 0x3F) << 6*2
-                tmp_b += (data[data_ptr + 4] & 0x3F) << 6
-                tmp_b += (data[data_ptr + 5] & 0x3F)
-                res.append(tmp_b)
-                data_ptr += 6
-            else:
-                raise Exception(f"decode utf-8 error, bytes:{data}")
-        # print(res)
-        # 处理内嵌的u16be编码字节
-        final_res = ""
-        index = 0
-        while (index < len(res)):
-            # 4字节u16be编码, 2+2存放, TODO. 也许会有4字节放一起的形式, 目前没见到先不写
-            if res[index] & 0xFC00 == 0xD800:
-                if res[index + 1] & 0xFC00 == 0xDC00:
-                    final_res += (res[index].to_bytes(2, "big") + res[index + 1].to_bytes(2, "big")).decode("utf-16be")
-                    index += 2
-                    continue
-            # 2字节u16be编码, 应该不存在这种情况, 保险起见还是写上
-            elif res[index] & 0xFCFC == 0xD8DC:
-                final_res += res[index].to_bytes(2, "big").decode("utf-16be")
-
-            # unicode编号, 直接转字符串
-            else:
-                final_res += chr(res[index])
-            index += 1
-
-        return final_res
+        先解出每个unicode编号(代理用surrogatepass保留, python不接受的序列交给_utf8_recover),
+        再把内嵌的u16编码的代理对合成一个字符
+        """
+        try:
+            text = data.decode("utf-8", "surrogatepass")
+        except UnicodeDecodeError:
+            text = data.decode("utf-8", UTF8_RECOVER_ERRORS)
+        return _join_surrogates(text)
 
 
     def _decode_utf8(self, offset:int) -> str:
@@ -329,7 +684,12 @@ class StringPool(ResChunkHeader):
         encoded_bytes, skip = self._decode_length(offset, 1)
         offset += skip
 
-        data_b = self.buff[offset: offset + encoded_bytes]
+        return self._decode_utf8_data(self.buff[offset: offset + encoded_bytes])
+
+    def _decode_utf8_data(self, data_b:bytes) -> str:
+        '''
+        解码utf-8字符串的数据部分
+        '''
         # 解码失败时，不要直接报错或者返回空，把解码出来的unicode代号拼在一起，再次尝试u16be解码
         # 这样就不能用python自己的decode，需要自己写解码逻辑
         # 示例sha1：4bf11f72edaf8e23055991e565baa86d1370dbd2，此apk的app_name
@@ -379,7 +739,7 @@ class StringPool(ResChunkHeader):
         fmt = "<2{}".format('B' if sizeof_char == 1 else 'H')
         highbit = 0x80 << (8 * (sizeof_char - 1))
 
-        length1, length2 = struct.unpack(fmt, self.buff[offset:(offset + sizeof_2chars)])
+        length1, length2 = struct.unpack_from(fmt, self.buff, offset)
 
         if (length1 & highbit) != 0:
             length = ((length1 & ~highbit) << (8 * sizeof_char)) | length2
@@ -444,7 +804,7 @@ class StartElement(ResChunkHeader):
         super().__init__(buff, offset)
 
         (self.line_num,
-        self.comment) = struct.unpack("<2I", self.buff[offset + RES_CHUNK_HEADER_SIZE: offset + RES_CHUNK_HEADER_SIZE + 8])
+        self.comment) = XML_NODE_STRUCT.unpack_from(buff, offset + RES_CHUNK_HEADER_SIZE)
 
         (self.ns,
         self.name,
@@ -453,15 +813,15 @@ class StartElement(ResChunkHeader):
         self.attribute_count,
         self.id_index,
         self.class_index,
-        self.style_index) = struct.unpack("<2I6H", self.buff[offset + self.header_size: offset + self.header_size + RES_XML_TREE_ATTREXT_SIZE])
+        self.style_index) = XML_ATTR_EXT_STRUCT.unpack_from(buff, offset + self.header_size)
 
-        self.attributes:List[AxmlAttribute] = []
+        if self.attribute_count and self.attribute_size < RES_XML_TREE_ATTRIBUTE_SIZE:
+            raise Exception(f"StartElement attribute size error: {self.attribute_size}")
 
-        index = self.header_size + self.attribute_start
-        for i in range(self.attribute_count):
-            tmp = AxmlAttribute(self.buff[offset + index: offset + index + self.attribute_size])
-            self.attributes.append(tmp)
-            index += self.attribute_size
+        # 直接从原始数据中按偏移读取每个属性，不做切片
+        index = offset + self.header_size + self.attribute_start
+        self.attributes:List[AxmlAttribute] = [AxmlAttribute(buff, i) for i in
+                range(index, index + self.attribute_count * self.attribute_size, self.attribute_size)]
 
 
 class EndElement(ResChunkHeader):
@@ -469,10 +829,10 @@ class EndElement(ResChunkHeader):
         super().__init__(buff, offset)
 
         (self.line_num,
-        self.comment) = struct.unpack("<2I", self.buff[offset + RES_CHUNK_HEADER_SIZE: offset + RES_CHUNK_HEADER_SIZE + 8])
+        self.comment) = XML_NODE_STRUCT.unpack_from(buff, offset + RES_CHUNK_HEADER_SIZE)
 
         (self.ns,
-        self.name) = struct.unpack("<2I", self.buff[offset + self.header_size: offset + self.header_size + 8])
+        self.name) = XML_END_ELEMENT_STRUCT.unpack_from(buff, offset + self.header_size)
 
 
 class CData(ResChunkHeader):
@@ -482,93 +842,101 @@ class CData(ResChunkHeader):
             pass # TODO add log
 
         (self.line_num,
-        self.comment) = struct.unpack("<2I", self.buff[offset + RES_CHUNK_HEADER_SIZE: offset + RES_CHUNK_HEADER_SIZE + 8])
+        self.comment) = XML_NODE_STRUCT.unpack_from(buff, offset + RES_CHUNK_HEADER_SIZE)
 
-        self.raw_data = struct.unpack("<I", self.buff[offset + RES_CHUNK_HEADER_SIZE + 8: offset + RES_CHUNK_HEADER_SIZE + 12])
+        self.raw_data = struct.unpack_from("<I", buff, offset + RES_CHUNK_HEADER_SIZE + 8)
 
-        self.typed_data = ResValue(self.buff[offset + RES_CHUNK_HEADER_SIZE + 12: offset + RES_CHUNK_HEADER_SIZE + 20])
+        self.typed_data = ResValue(buff, offset + RES_CHUNK_HEADER_SIZE + 12)
 
 
 class AxmlAttribute:
-    def __init__(self, buff: bytes) -> None:
+    __slots__ = ("ns", "name", "raw_value", "value")
+
+    def __init__(self, buff: bytes, offset:int = 0) -> None:
         (self.ns,
         self.name,
-        self.raw_value) = struct.unpack("<3I", buff[:12])
+        self.raw_value) = XML_ATTRIBUTE_STRUCT.unpack_from(buff, offset)
         
         # res_value 的结构体固定长8字节
-        self.value:ResValue = ResValue(buff[12:20])
+        self.value:ResValue = ResValue(buff, offset + 12)
 
 
 class ResValue:
-    def __init__(self, buff: bytes) -> None:
-        if len(buff) != RES_VALUE_SIZE:
-            pass # TODO add log: res value length error
+    __slots__ = ("size", "res0", "data_type", "data")
 
+    def __init__(self, buff: bytes, offset:int = 0) -> None:
         (self.size,
         self.res0,
         self.data_type,
-        self.data) = struct.unpack("<H2BI", buff)
-
-        self.data_bin:bytes = buff[4:]    # 二进制的data
+        self.data) = RES_VALUE_STRUCT.unpack_from(buff, offset)
 
         if self.data_type > 0x1f:
             logger.error(f"res value type error,type:{self.data_type}") 
+
+    @property
+    def data_bin(self) -> bytes:
+        '''
+        二进制的data
+        '''
+        return struct.pack("<I", self.data)
     
     def parse_data(self, string_pool:StringPool):
         '''
         使用指定的字符串池解析当前的value
         '''
-        self.string_pool = string_pool
-
         # Type of the data value.
-        decode_methods = {       
-            0x00:self._type_null,       # TYPE_NULL
-            0x01:self._type_reference,  # TYPE_REFERENCE
-            0x02:self._type_tmp,        # TYPE_ATTRIBUTE
-            0x03:self._type_string,     # TYPE_STRING
-            0x04:self._type_float,      # TYPE_FLOAT
-            0x05:self._type_tmp,        # TYPE_DIMENSION
-            0x06:self._type_tmp,        # TYPE_FRACTION
-            0x07:self._type_tmp,        # TYPE_DYNAMIC_REFERENCE
-            0x08:self._type_tmp,        # TYPE_DYNAMIC_ATTRIBUTE
-            0x10:self._type_int_dec,    # TYPE_INT_DEC
-            0x11:self._type_int_hex,    # TYPE_INT_HEX
-            0x12:self._type_int_bool,   # TYPE_INT_BOOLEAN
-            0x1c:self._type_int_hex,    # TYPE_INT_COLOR_ARGB8  # 颜色没必要解析，就用十六进制表示
-            0x1d:self._type_int_hex,    # TYPE_INT_COLOR_RGB8
-            0x1e:self._type_int_hex,    # TYPE_INT_COLOR_ARGB4
-            0x1f:self._type_int_hex,    # TYPE_INT_COLOR_RGB4
-        }
-
+        method = self._decode_methods.get(self.data_type)
+        if method is None:
+            return None
         try:
-            return decode_methods[self.data_type]()
+            return method(self, string_pool)
         except:
             return None
 
-    def _type_tmp(self):    # TODO complete these methods.
+    def _type_tmp(self, string_pool:StringPool):    # TODO complete these methods.
         return self.data
 
-    def _type_null(self):
+    def _type_null(self, string_pool:StringPool):
         return None
 
-    def _type_reference(self):
+    def _type_reference(self, string_pool:StringPool):
         return hex(self.data)
 
-    def _type_string(self):
-        return self.string_pool.get_string(self.data)
+    def _type_string(self, string_pool:StringPool):
+        return string_pool.get_string(self.data)
     
-    def _type_int_dec(self):
+    def _type_int_dec(self, string_pool:StringPool):
         return self.data
 
-    def _type_int_hex(self):
+    def _type_int_hex(self, string_pool:StringPool):
         return hex(self.data)
     
-    def _type_int_bool(self):
+    def _type_int_bool(self, string_pool:StringPool):
         return True if self.data else False
 
-    def _type_float(self):
+    def _type_float(self, string_pool:StringPool):
         return struct.unpack("<f", self.data_bin)
 
+    # 各种类型的解析方法，在类定义时创建一次，不用每次解析都创建
+    _decode_methods = {
+        0x00:_type_null,       # TYPE_NULL
+        0x01:_type_reference,  # TYPE_REFERENCE
+        0x02:_type_tmp,        # TYPE_ATTRIBUTE
+        0x03:_type_string,     # TYPE_STRING
+        0x04:_type_float,      # TYPE_FLOAT
+        0x05:_type_tmp,        # TYPE_DIMENSION
+        0x06:_type_tmp,        # TYPE_FRACTION
+        0x07:_type_tmp,        # TYPE_DYNAMIC_REFERENCE
+        0x08:_type_tmp,        # TYPE_DYNAMIC_ATTRIBUTE
+        0x10:_type_int_dec,    # TYPE_INT_DEC
+        0x11:_type_int_hex,    # TYPE_INT_HEX
+        0x12:_type_int_bool,   # TYPE_INT_BOOLEAN
+        0x1c:_type_int_hex,    # TYPE_INT_COLOR_ARGB8  # 颜色没必要解析，就用十六进制表示
+        0x1d:_type_int_hex,    # TYPE_INT_COLOR_RGB8
+        0x1e:_type_int_hex,    # TYPE_INT_COLOR_ARGB4
+        0x1f:_type_int_hex,    # TYPE_INT_COLOR_RGB4
+    }
+
 
 
     # Structure of complex data values (TYPE_UNIT and TYPE_FRACTION)
@@ -624,6 +992,9 @@ class ResValue:
 #######################
 
 class ResTableEntry:
+    # 每个配置(语言等)的每个资源都有一个entry，数量很多，不使用__dict__
+    __slots__ = ("size", "flag", "key_str_id", "ref_parant", "count", "value", "key_sp")
+
     # flag的取值
     FLAG_COMPLEX    = 0x0001    # 此entry后面跟着ResTable_map
     FLAG_PUBLIC     = 0x0002    # 此entry为公有，可被其他库引用
@@ -644,10 +1015,15 @@ class ResTableEntry:
 
             self.value = {"map object":"is not yet parsed"}
         else:
-            self.value = ResValue(buff[offset + 8: offset + 16])
+            self.value = ResValue(buff, offset + 8)
+
+        # 资源名用到时再从字符串池获取，同一个Arsc中相同的字符串只保存一份
+        self.key_sp = key_sp
+
+    @property
+    def key_str(self) -> str:
+        return self.key_sp.get_string(self.key_str_id)
 
-        self.key_str = key_sp.get_string(self.key_str_id)
-        
 
 class ResTablePackage(ResChunkHeader):
     # 资源id形式如：0x7f010002
@@ -657,13 +1033,14 @@ class ResTablePackage(ResChunkHeader):
     # 一般在android开发中写法为@res_type/res_name，与资源id的0x010002相对应
     # 此结构体中的两个字符串池 type_str_pool，key_str_pool就是保存的res_type和res_name字符串
 
-    def __init__(self, buff: bytes, global_sp:StringPool) -> None:
+    def __init__(self, buff: bytes, global_sp:StringPool, table:StringTable = None) -> None:
         '''
         读取table package信息
 
         args:
             buff: 待分析的数据块
             global_sp: 全局字符串池，表示此arsc文件的字符串池，部分属性的解析需要用到
+            table: 字符串驻留表，一般和全局字符串池共用，类型名和资源名全部存入table
         '''
         super().__init__(buff)
 
@@ -680,8 +1057,9 @@ class ResTablePackage(ResChunkHeader):
                             self.buff[RES_CHUNK_HEADER_SIZE: RES_TABLE_PACKAGE_HEADER_SIZE])
         logger.debug(f"ResTablePackage: id:{hex(self.id)},len:{hex(self.size)}")
 
-        self.type_str_pool:StringPool = StringPool(self.buff[self.type_str_offset:])
-        self.key_str_pool:StringPool = StringPool(self.buff[self.key_str_offset:])
+        # 类型名和资源名数量不多，而且每个配置的entry都会用到，不限制缓存数量
+        self.type_str_pool:StringPool = StringPool(self.buff, offset=self.type_str_offset, cache_size=None, table=table)
+        self.key_str_pool:StringPool = StringPool(self.buff, offset=self.key_str_offset, cache_size=None, table=table)
 
         # table package spec dict: {type_id: type_spec, ...}
         self.specs:Dict[int, ResTypeSpec] = {}
@@ -689,20 +1067,22 @@ class ResTablePackage(ResChunkHeader):
         # table package Types dict: {type_id: [type_type1, type_type2, ... ], ...}
         self.tp_types:Dict[int, List[ResTableType]] = {}
 
+        # 子数据块使用memoryview，每个ResTableType不再各自复制一份后面的全部数据
+        view = memoryview(self.buff)
         self.ptr = self.key_str_offset + self.key_str_pool.size
         while (self.ptr < self.size):
             next_chunk_type = struct.unpack("<H", self.buff[self.ptr: self.ptr + 2])[0]
             # print(self.ptr, next_chunk_type)
             if next_chunk_type == RES_TABLE_TYPE_SPEC_TYPE:
-                tmp_obj = ResTypeSpec(self.buff[self.ptr:])
+                tmp_obj = ResTypeSpec(view[self.ptr:])
                 self.specs[tmp_obj.id] = tmp_obj
                 self._ptr_add(tmp_obj.size)
             elif next_chunk_type == RES_TABLE_TYPE_TYPE:
-                tmp_obj = ResTableType(self.buff[self.ptr:], global_sp, self.key_str_pool)
+                tmp_obj = ResTableType(view[self.ptr:], global_sp, self.key_str_pool)
                 self.tp_types.setdefault(tmp_obj.id, []).append(tmp_obj)
                 self._ptr_add(tmp_obj.size)
             else:   # TODO 完善其他数据块的读取
-                h = ResChunkHeader(self.buff[self.ptr:])
+                h = ResChunkHeader(view[self.ptr:])
                 logger.debug(f"ResTablePackage: read unknow chunk:{h.res_type},size:{h.size}")
                 self._ptr_add(h.size)
 
@@ -741,7 +1121,7 @@ class ResTableType(ResChunkHeader):
         # TODO 完善config解析，config用于资源的语言适配，屏幕大小适配等，反编译一般用不到这个东西，暂不处理
         # config是在ResChunkHeader头部里面的，只能用固定长度0x14获取到其位置了
         self.config_count = struct.unpack("<I",self.buff[0x14: 0x18])[0]
-        self.config:bytes = self.buff[0x14: 0x14 + self.config_count]
+        self.config:bytes = bytes(self.buff[0x14: 0x14 + self.config_count])
 
         entry_off_end = self.header_size + self.entry_count*4
         self.entry_offsets:Tuple[int, ...] = struct.unpack(f"<{self.entry_count}I", 
@@ -778,14 +1158,108 @@ class ResTableType(ResChunkHeader):
 #                     #
 #######################
 
+class AxmlNode:
+    '''
+    轻量的xml节点，只实现了lxml Element中常用的部分接口(tag, attrib, get, find, iter, getparent)
+
+    属性保存为 ((key, value), ...)，节点的属性一般只有几个，顺序查找即可
+    '''
+    __slots__ = ("tag", "attrs", "children", "parent")
+
+    def __init__(self, tag:str, attrs:Tuple[Tuple[str, str], ...] = ()) -> None:
+        self.tag:str = tag
+        self.attrs:Tuple[Tuple[str, str], ...] = attrs
+        self.children:List[AxmlNode] = []
+        self.parent:AxmlNode = None
+
+    @property
+    def attrib(self) -> Dict[str, str]:
+        return dict(self.attrs)
+
+    def get(self, key:str, default:str = None) -> str:
+        for k, v in self.attrs:
+            if k == key:
+                return v
+        return default
+
+    def append(self, node:"AxmlNode") -> None:
+        node.parent = self
+        self.children.append(node)
+
+    def getparent(self) -> "AxmlNode":
+        return self.parent
+
+    def find(self, tag:str) -> "AxmlNode":
+        '''
+        返回第一个标签名为tag的子节点(只查找直接子节点)
+        '''
+        for child in self.children:
+            if child.tag == tag:
+                return child
+        return None
+
+    def iter(self, tag:str = None) -> Iterator["AxmlNode"]:
+        '''
+        按文档顺序遍历自己和所有子孙节点，tag不为None时只返回标签名为tag的节点
+        '''
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if tag is None or node.tag == tag:
+                yield node
+            stack.extend(reversed(node.children))
+
+    def __iter__(self) -> Iterator["AxmlNode"]:
+        return iter(self.children)
+
+    def __len__(self) -> int:
+        return len(self.children)
+
+    def __repr__(self) -> str:
+        return f"<AxmlNode {self.tag}>"
+
+    def to_lxml(self):
+        '''
+        转换成lxml的Element(包括所有子节点)，需要安装lxml
+        '''
+        from lxml import etree
+        root = None
+        stack = [(self, None)]
+        while stack:
+            node, parent = stack.pop()
+            # 有apk会故意加入错误字符，导致无法解析成标准xml，只要app没有使用此字符串，则可以正常安装
+            # 这里如果遇到这种对抗，就插入一个空的node
+            try:
+                element = etree.Element(node.tag, attrib=dict(node.attrs), nsmap=None)
+            except Exception as e:
+                element = etree.Element(node.tag, attrib={"this":"is_not_a_valid_unicode_str"}, nsmap=None)
+                logger.warning("_create_node error:" + str(e))
+            if parent is None:
+                root = element
+            else:
+                parent.append(element)
+            stack.extend((child, element) for child in reversed(node.children))
+        return root
+
+
 class Axml(ResChunkHeader):
     
-    def __init__(self, buff: bytes, pre_decode:bool = True) -> None:
+    def __init__(self, buff: bytes, pre_decode:bool = False, build_tree:bool = True) -> None:
+        '''
+        Args:
+            buff: 二进制xml数据
+            pre_decode: 预先解码全部字符串，默认在使用时才解码
+            build_tree: 解析全部chunk并创建xml树，为False时什么都不解析，只通过iter_events()流式读取
+        '''
         super().__init__(buff)
         self.pre_decode = pre_decode
 
         self.string_pool:StringPool = None
         self.res_map:ResMap = None
+        self._string_pool_ptr:int = None        # 字符串池和资源id表在buff中的位置，再次遍历时同一位置的直接复用
+        self._res_map_ptr:int = None
+        self._names:List[str] = None            # _parse_name()的结果，按字符串序号保存
+        self._attr_keys:Dict[int, str] = {}     # 属性的"{命名空间}属性名"，key为 (ns << 32) | name
         self.start_nss:List[StartNS] = []
         self.end_nss:List[EndNS] = []
         self.start_elements:List[StartElement] = []
@@ -796,121 +1270,227 @@ class Axml(ResChunkHeader):
         # 下面有相应的解析函数_parse_nodes_dict()
         self.xml_nodes_dict:Dict[str,list] = {}
 
-        self.node_ptr = None
-        first_tag = ""
-        count = 0
-        while(self.ptr < self.size):
-            # 命名空间关闭后，后面的是脏数据
-            if self.start_nss != [] and len(self.start_nss) == len(self.end_nss):
-                break
-
-            next_chunk_type = struct.unpack("<H", self.buff[self.ptr: self.ptr + 2])[0]
+        self.node_ptr:AxmlNode = None
+        if not build_tree:
+            return
 
-            # 出现频率高的类型往前放，提高效率
-            # 会大量重复出现的块尽可能减少切片操作，否则会爆内存
-            if next_chunk_type == RES_XML_START_ELEMENT_TYPE:
-                tmp = StartElement(self.buff, self.ptr)
+        first_tag = ""
+        # 从根节点到当前节点的路径，栈顶为当前节点，每个节点的增加和返回父节点都是O(1)
+        node_stack:List[AxmlNode] = []
+        for chunk_type, tmp in self._iter_chunks():
+            if chunk_type == RES_XML_START_ELEMENT_TYPE:
                 tmp_node = self._create_node(tmp)
                 if tmp_node == None:
-                    self._ptr_add(tmp.size)
                     continue
-                if count == 0:  # first_node
-                    self.node_ptr = tmp_node
+                if not self.start_elements:  # first_node
                     first_tag = tmp_node.tag
                 else:
-                    self.node_ptr.append(tmp_node)   # 增加当前节点，并指向它
-                    self.node_ptr = list(self.node_ptr)[-1]
+                    node_stack[-1].append(tmp_node)   # 增加当前节点，并指向它
+                node_stack.append(tmp_node)
                 self.start_elements.append(tmp)
-                self._ptr_add(tmp.size)
-                count += 1
 
             # 发现一个样本，manifest的最后一个end_element没有name，不确定是不是所有的end_element都能这样，先跳过这个特例
             # 如果后续发现新样本，确定了所有end_element都可以没有name，则可以删掉下面“名称匹配”的if分支，遇到end_element
             # 直接返回父节点
-            elif next_chunk_type == RES_XML_END_ELEMENT_TYPE:
-                tmp = EndElement(self.buff, self.ptr)
+            elif chunk_type == RES_XML_END_ELEMENT_TYPE:
                 tmp_name = self.string_pool.get_string(tmp.name)
-                if tmp_name == first_tag or self.node_ptr.tag == first_tag:    # 遇到第一个node表示xml解析完成
+                if tmp_name == first_tag or node_stack[-1].tag == first_tag:    # 遇到第一个node表示xml解析完成
                     pass
-                elif tmp_name != self.node_ptr.tag:   # 一个node的结尾需要与开头名称匹配，如<activity>xxxx</activity>
-                    raise Exception(f"Parse xml error. start_tag not equal to end_tag: {self.node_ptr.tag}=={tmp_name}")
+                elif tmp_name != node_stack[-1].tag:   # 一个node的结尾需要与开头名称匹配，如<activity>xxxx</activity>
+                    raise Exception(f"Parse xml error. start_tag not equal to end_tag: {node_stack[-1].tag}=={tmp_name}")
                 else:
-                    self.node_ptr = self.node_ptr.getparent()
+                    node_stack.pop()
                 self.end_elements.append(tmp)
-                self._ptr_add(tmp.size)
 
-            elif next_chunk_type == RES_XML_CDATA_TYPE:
-                tmp = CData(self.buff, self.ptr)
+            elif chunk_type == RES_XML_CDATA_TYPE:
                 self.cdatas.append(tmp)
-                self._ptr_add(tmp.size)
 
+            elif chunk_type == RES_XML_START_NAMESPACE_TYPE:
+                self.start_nss.append(tmp)
+
+            elif chunk_type == RES_XML_END_NAMESPACE_TYPE:
+                self.end_nss.append(tmp)
+
+        if node_stack:
+            self.node_ptr = node_stack[-1]
+
+    def _iter_chunks(self, raw:bool = False) -> Iterator[Tuple[int, Union[ResChunkHeader, int]]]:
+        '''
+        从头依次解析各个chunk，字符串池和资源id表直接保存到self中，
+        StartElement, EndElement, CData, StartNS, EndNS 以 (chunk类型, 解析出的对象) 的形式返回
+
+        raw为True时StartElement, EndElement, CData不创建对象，返回 (chunk类型, chunk在buff中的偏移)
+        '''
+        ptr = RES_CHUNK_HEADER_SIZE
+        start_ns_count = 0
+        end_ns_count = 0
+        while(ptr < self.size):
+            # 命名空间关闭后，后面的是脏数据
+            if start_ns_count != 0 and start_ns_count == end_ns_count:
+                break
+
+            next_chunk_type = struct.unpack_from("<H", self.buff, ptr)[0]
+
+            # 出现频率高的类型往前放，提高效率
+            # 会大量重复出现的块尽可能减少切片操作，否则会爆内存
+            if raw and RES_XML_START_ELEMENT_TYPE <= next_chunk_type <= RES_XML_CDATA_TYPE:
+                yield next_chunk_type, ptr
+                chunk_size = CHUNK_HEADER_STRUCT.unpack_from(self.buff, ptr)[2]
+
+            elif next_chunk_type == RES_XML_START_ELEMENT_TYPE:
+                tmp = StartElement(self.buff, ptr)
+                yield next_chunk_type, tmp
+                chunk_size = tmp.size
+
+            elif next_chunk_type == RES_XML_END_ELEMENT_TYPE:
+                tmp = EndElement(self.buff, ptr)
+                yield next_chunk_type, tmp
+                chunk_size = tmp.size
+
+            elif next_chunk_type == RES_XML_CDATA_TYPE:
+                tmp = CData(self.buff, ptr)
+                yield next_chunk_type, tmp
+                chunk_size = tmp.size
+
+            # 再次遍历时(如建树之后调用iter_events)，同一位置的字符串池和资源id表直接复用，
+            # 已经解码的字符串和名称缓存都保留
             elif next_chunk_type == RES_STRING_POOL_TYPE:
-                self.string_pool = StringPool(self.buff[self.ptr:], pre_decode)
-                self._ptr_add(self.string_pool.size)
+                if self.string_pool is None or self._string_pool_ptr != ptr:
+                    self.string_pool = StringPool(self.buff, self.pre_decode, ptr)
+                    self._string_pool_ptr = ptr
+                    self._reset_names()
+                chunk_size = self.string_pool.size
 
             elif next_chunk_type == RES_XML_RESOURCE_MAP_TYPE:
-                self.res_map = ResMap(self.buff[self.ptr:])
-                self._ptr_add(self.res_map.size)
+                if self.res_map is None or self._res_map_ptr != ptr:
+                    self.res_map = ResMap(self.buff[ptr:])
+                    self._res_map_ptr = ptr
+                    self._reset_names()
+                chunk_size = self.res_map.size
 
             elif next_chunk_type == RES_XML_START_NAMESPACE_TYPE:
-                tmp = StartNS(self.buff[self.ptr:])
-                self.start_nss.append(tmp)
-                self._ptr_add(tmp.size)
+                tmp = StartNS(self.buff[ptr:])
+                start_ns_count += 1
+                yield next_chunk_type, tmp
+                chunk_size = tmp.size
 
             elif next_chunk_type == RES_XML_END_NAMESPACE_TYPE:
-                tmp = EndNS(self.buff[self.ptr:])
-                self.end_nss.append(tmp)
-                if tmp.size <= START_NAMESPACE_SIZE:
-                    self._ptr_add(START_NAMESPACE_SIZE)
-                else:
-                    # 理论上可以自己添加额外数据
-                    self._ptr_add(tmp.size)
+                tmp = EndNS(self.buff[ptr:])
+                end_ns_count += 1
+                yield next_chunk_type, tmp
+                # 理论上可以自己添加额外数据
+                chunk_size = max(tmp.size, START_NAMESPACE_SIZE)
+
             # 部分标准块没有解析，需要按长度跳过
             elif (next_chunk_type >= RES_NULL_TYPE and next_chunk_type <= RES_XML_TYPE) \
                 or (next_chunk_type >= RES_XML_FIRST_CHUNK_TYPE and next_chunk_type <= RES_XML_LAST_CHUNK_TYPE):
                 logger.warning(f"unparsed chunk type:{next_chunk_type}")
-                self._ptr_add(ResChunkHeader(self.buff, self.ptr).size)
+                chunk_size = max(ResChunkHeader(self.buff, ptr).size, 4)
             else:
                 logger.warning(f"undefined chunk type:{next_chunk_type}")
-                self._ptr_add(4)
-                continue
+                chunk_size = 4
 
+            # 4字节对齐
+            ptr = (ptr + chunk_size + 3) & ~3
 
-    def _create_node(self, element:StartElement) -> Union[Element,None]:
+    def _reset_names(self) -> None:
         '''
-        使用StartElement实例创建xml node
+        字符串池或资源id表变化后，缓存的名称失效
+        '''
+        self._names = None
+        self._attr_keys = {}
+
+    def iter_events(self) -> Iterator[Tuple[str, str, Union[Dict[str, str], str], int]]:
+        '''
+        流式读取xml，不创建xml树，也不保存解析过的chunk，每次调用都从头开始解析(字符串池和名称缓存会复用)
+
+        返回 (event, tag, attrs, line):
+            EVENT_START_ELEMENT: tag为标签名，attrs为属性字典 {"{命名空间}属性名": 字符串值}，和xml树中的属性一致
+            EVENT_END_ELEMENT: tag为对应开始节点的标签名，attrs为None
+            EVENT_CDATA: tag为None，attrs为文本
+            EVENT_START_NS, EVENT_END_NS: tag为prefix，attrs为uri
+        tag name异常的节点和xml树一样会被跳过(连同对应的结束事件)，只保存当前路径上的标签名，内存占用和文件大小无关
+        '''
+        tags = []   # 当前路径上各层的标签名，被跳过的节点为""
+        for chunk_type, chunk in self._iter_chunks():
+            if chunk_type == RES_XML_START_ELEMENT_TYPE:
+                tag = self.string_pool.get_string(chunk.name)
+                tags.append(tag)
+                if tag == "":
+                    continue
+                yield EVENT_START_ELEMENT, tag, self._parse_attributes(chunk), chunk.line_num
+            elif chunk_type == RES_XML_END_ELEMENT_TYPE:
+                # 有的样本结束节点没有name，以开始节点为准
+                tag = tags.pop() if tags else self.string_pool.get_string(chunk.name)
+                if tag == "":
+                    continue
+                yield EVENT_END_ELEMENT, tag, None, chunk.line_num
+            elif chunk_type == RES_XML_CDATA_TYPE:
+                yield EVENT_CDATA, None, self.string_pool.get_string(chunk.raw_data[0]), chunk.line_num
+            elif chunk_type in (RES_XML_START_NAMESPACE_TYPE, RES_XML_END_NAMESPACE_TYPE):
+                event = EVENT_START_NS if chunk_type == RES_XML_START_NAMESPACE_TYPE else EVENT_END_NS
+                yield event, self._get_ns_string(chunk.prefix), self._get_ns_string(chunk.uri), chunk.line_num
+
+    def _get_ns_string(self, idx:int) -> str:
+        '''
+        命名空间的prefix和uri, 0xffffffff表示没有
+        '''
+        if idx == 0xffffffff:
+            return ""
+        return self.string_pool.get_string(idx)
+
+    @classmethod
+    def read_root_attributes(cls, buff: bytes) -> Dict[str, object]:
+        '''
+        快速读取根节点(如manifest)的属性，不解析整个xml：
+        只解析到第一个StartElement为止，字符串池不预先解码，也不创建xml node
+
+        return:
+            {属性名(不含命名空间): parse_data()解析出的值}
+        '''
+        axml = cls(buff, pre_decode=False, build_tree=False)
+        for chunk_type, element in axml._iter_chunks():
+            if chunk_type != RES_XML_START_ELEMENT_TYPE:
+                continue
+            # 和_create_node一致，tag name异常的node直接跳过
+            if axml.string_pool.get_string(element.name) == "":
+                continue
+            return {axml._parse_name(attr.name): attr.value.parse_data(axml.string_pool)
+                    for attr in element.attributes}
+        return {}
+
+    def _parse_attributes(self, element:StartElement) -> Dict[str, str]:
+        '''
+        解析StartElement的属性，返回 {"{命名空间}属性名": 字符串值}
         '''
         attr_dict = {}
+        attr_keys = self._attr_keys
         for attr in element.attributes:
-            attr_ns = self._parse_name(attr.ns)
-            attr_name = self._parse_name(attr.name)
-            if attr_ns:
-                key = "{{{0}}}{1}".format(attr_ns, attr_name)
-            else:
-                key = attr_name
+            # "{命名空间}属性名"按(ns, name)的序号缓存，同一个文档中只拼接一次
+            key_id = (attr.ns << 32) | attr.name
+            key = attr_keys.get(key_id)
+            if key is None:
+                attr_ns = self._parse_name(attr.ns)
+                attr_name = self._parse_name(attr.name)
+                if attr_ns:
+                    key = "{{{0}}}{1}".format(attr_ns, attr_name)
+                else:
+                    key = attr_name
+                attr_keys[key_id] = key
             # xml中所有的value都是字符串格式，这里要用str()转换一下
             attr_dict[key] = str(attr.value.parse_data(self.string_pool))
-        
-        # 有apk会故意加入错误字符，导致无法解析成标准xml，只要app没有使用此字符串，则可以正常安装
-        # 这里如果遇到这种对抗，就插入一个空的node
+        return attr_dict
+
+    def _create_node(self, element:StartElement) -> Union[AxmlNode,None]:
+        '''
+        使用StartElement实例创建xml node
+        '''
         # 如果tag name被插入错误字符，则直接返回None，错误的tag 并没有实际作用，只是妨碍逆向
+        # 属性中的错误字符在转换成lxml时(AxmlNode.to_lxml)处理
         tag_name = self.string_pool.get_string(element.name)
         if tag_name == "":
             return None
-        try:
-            node:Element = etree.Element(
-                tag_name,
-                attrib=attr_dict,
-                nsmap=None
-            )
-        except Exception as e:
-            node:Element = etree.Element(
-                tag_name,
-                attrib={"this":"is_not_a_valid_unicode_str"},
-                nsmap=None
-            )
-            logger.warning("_create_node error:" + str(e))
-        return node
+        return AxmlNode(tag_name, tuple(self._parse_attributes(element).items()))
 
 
     def _parse_nodes_dict(self):
@@ -936,7 +1516,23 @@ class Axml(ResChunkHeader):
 
         取值顺序, 前一个地方取不到name再到后面找: res_map -> string_pool
 
-        如果解析出错, 返回空字符串
+        如果解析出错, 返回空字符串; 结果按字符串序号缓存在self._names中，每个序号只解析一次
+        '''
+        names = self._names
+        if names is None:
+            # 按实际读到的偏移数分配，不信任头部的字符串数
+            names = self._names = [None] * (min(self.string_pool.string_cnt, len(self.string_pool.string_offsets))
+                                            if self.string_pool else 0)
+        if 0 <= idx < len(names):
+            name = names[idx]
+            if name is None:
+                name = names[idx] = self._resolve_name(idx)
+            return name
+        return self._resolve_name(idx)
+
+    def _resolve_name(self, idx:int) -> str:
+        '''
+        _parse_name的实际解析过程
         '''
         #某些namespace字段可能取这个值，用于表示没有namespace
         if idx == 0xffffffff:
@@ -967,21 +1563,231 @@ class Axml(ResChunkHeader):
         '''
         返回所有字符串
         '''
-        if self.pre_decode:
-            return list(self.string_pool.strings.values())
-        else:
-            raise Exception("Strings are not decoded. ")
+        if self.string_pool is None:
+            return []
+        return self.string_pool.list_strings()
 
 
     def get_xml_str(self) -> str:
         '''
-        返回字符串格式的xml数据
+        返回字符串格式的xml数据，需要安装lxml
+        '''
+        from lxml import etree
+        # 从根节点开始转换，保证命名空间的声明和直接创建lxml树时一致
+        root = self.node_ptr
+        path = []
+        while root.parent is not None:
+            path.append(root.parent.children.index(root))
+            root = root.parent
+        element = root.to_lxml()
+        for i in reversed(path):
+            element = element[i]
+        return etree.tostring(element, encoding="utf-8").decode('utf-8')
+
+    def write_xml(self, sink:Union[io.TextIOBase, io.BufferedIOBase], indent:str = "  ", render_refs:bool = False) -> None:
+        '''
+        不创建xml树，直接按chunk顺序把xml文本写入sink，内存占用和文件大小无关，适合批量导出
+        (创建时使用 build_tree=False 可以省掉建树的开销)
+
+        和get_xml_str()的区别：命名空间使用StartNS中的prefix(如android:name)，而不是lxml自动生成的ns0；
+        属性值和xml树中一致，tag name异常的节点同样跳过，属性中有非法字符的节点同样替换为 this="is_not_a_valid_unicode_str"
+
+        Args:
+            sink: 文本流(io.TextIOBase)时直接写入字符串，否则按utf-8编码后写入bytes
+            indent: 每一层的缩进，为空时不换行也不缩进
+            render_refs: 资源引用显示为 @0x7f010001 (属性引用为 ?0x7f010001)，默认和xml树中一样为 0x7f010001
+        '''
+        if isinstance(sink, io.TextIOBase):
+            write = sink.write
+        else:
+            write = lambda text: sink.write(text.encode("utf-8"))
+        newline = "\n" if indent else ""
+        string_pool_get = None
+
+        out:List[str] = [XML_DECLARATION]
+        tags:List[str] = []         # 当前路径上各层的标签名(带prefix)，被跳过的节点为""
+        states:List[int] = []       # 已写出的各层节点的状态: 0 没有内容, 1 有子节点, 2 有文本(之后不再缩进)
+        open_tag = False            # 最后写出的开始标签还没有写">"
+        prefixes:Dict[str, List[str]] = {}      # uri -> prefix栈
+        pending_ns:List[Tuple[str, str]] = []   # 下一个节点上需要声明的 (prefix, uri)
+        auto_prefixes:Dict[str, str] = {}       # 没有声明过的uri，自动生成ns0, ns1 ...
+        attr_names:Dict[int, Tuple[str, bool]] = {}     # (ns << 32) | name -> (带prefix的属性名, 属性名是否合法)，命名空间变化时清空
+
+        buff = self.buff
+        # 节点直接从原始数据中读取，不创建StartElement等对象
+        for chunk_type, chunk in self._iter_chunks(raw=True):
+            if string_pool_get is None and self.string_pool is not None:
+                string_pool_get = self.string_pool.get_string
+
+            if chunk_type == RES_XML_START_ELEMENT_TYPE:
+                header_size = CHUNK_HEADER_STRUCT.unpack_from(buff, chunk)[1]
+                (tag_ns, tag_name, attribute_start, attribute_size,
+                 attribute_count) = XML_ATTR_EXT_STRUCT.unpack_from(buff, chunk + header_size)[:5]
+                if attribute_count and attribute_size < RES_XML_TREE_ATTRIBUTE_SIZE:
+                    raise Exception(f"StartElement attribute size error: {attribute_size}")
+                tag = string_pool_get(tag_name)
+                if tag == "":
+                    tags.append("")
+                    continue
+
+                if open_tag:
+                    out.append(">")
+                if states:
+                    if states[-1] != 2:
+                        states[-1] = 1
+                        out.append(newline + indent * len(states))
+
+                decls = {}      # 当前节点上的命名空间声明 {prefix: uri}
+                for prefix, uri in pending_ns:
+                    decls[prefix] = uri
+                pending_ns = []
+
+                if tag_ns != 0xffffffff:
+                    tag_uri = self._get_ns_string(tag_ns)
+                    if (prefixes.get(tag_uri) or [None])[-1] != "":     # 默认命名空间下的节点不需要prefix
+                        tag = self._get_prefix(tag_uri, prefixes, auto_prefixes, decls) + ":" + tag
+
+                attrs = {}
+                valid = True
+                index = chunk + header_size + attribute_start
+                for attr_offset in range(index, index + attribute_count * attribute_size, attribute_size):
+                    (attr_ns, attr_name_idx, _, _, _,
+                     data_type, data) = XML_ATTRIBUTE_VALUE_STRUCT.unpack_from(buff, attr_offset)
+                    key_id = (attr_ns << 32) | attr_name_idx
+                    name = attr_names.get(key_id)
+                    if name is None:
+                        attr_uri = self._parse_name(attr_ns)
+                        attr_name = self._parse_name(attr_name_idx)
+                        name_valid = XML_NAME.match(attr_name) is not None
+                        declared = False
+                        if attr_uri:
+                            declared = bool(prefixes.get(attr_uri)) and prefixes[attr_uri][-1] != ""
+                            attr_name = self._get_prefix(attr_uri, prefixes, auto_prefixes, decls) + ":" + attr_name
+                        name = (attr_name, name_valid)
+                        if not attr_uri or declared:    # 自动生成的prefix需要在每个节点上声明，不能缓存
+                            attr_names[key_id] = name
+                    attr_name, name_valid = name
+                    # 常见类型直接转换，结果和ResValue.parse_data()一致
+                    if data_type == TYPE_STRING:
+                        try:
+                            value = string_pool_get(data)
+                        except Exception:
+                            value = "None"
+                    elif data_type == TYPE_INT_DEC:
+                        value = str(data)
+                    elif render_refs and data_type in (TYPE_REFERENCE, TYPE_DYNAMIC_REFERENCE):
+                        value = "@0x%08x" % data
+                    elif render_refs and data_type in (TYPE_ATTRIBUTE, TYPE_DYNAMIC_ATTRIBUTE):
+                        value = "?0x%08x" % data
+                    else:
+                        value = str(ResValue(buff, attr_offset + 12).parse_data(self.string_pool))
+                    if not name_valid or INVALID_XML_CHARS.search(value) is not None:
+                        valid = False
+                    attrs[attr_name] = value
+
+                out.append("<" + tag)
+                for prefix, uri in decls.items():
+                    out.append(' xmlns:%s="%s"' % (prefix, _escape_xml(uri, True)) if prefix
+                               else ' xmlns="%s"' % _escape_xml(uri, True))
+                if valid:
+                    for key, value in attrs.items():
+                        out.append(' %s="%s"' % (key, _escape_xml(value, True)))
+                else:
+                    # 和AxmlNode.to_lxml()一致，有非法字符的节点替换为一个固定的属性
+                    logger.warning(f"write_xml: invalid attribute in <{tag}>")
+                    out.append(' this="is_not_a_valid_unicode_str"')
+                open_tag = True
+                tags.append(tag)
+                states.append(0)
+
+            elif chunk_type == RES_XML_END_ELEMENT_TYPE:
+                # 有的样本结束节点没有name，以开始节点为准
+                if tags:
+                    tag = tags.pop()
+                else:
+                    header_size = CHUNK_HEADER_STRUCT.unpack_from(buff, chunk)[1]
+                    tag = string_pool_get(XML_END_ELEMENT_STRUCT.unpack_from(buff, chunk + header_size)[1])
+                if tag == "" or not states:
+                    continue
+                state = states.pop()
+                if open_tag:
+                    out.append("/>")
+                    open_tag = False
+                else:
+                    if state == 1:
+                        out.append(newline + indent * len(states))
+                    out.append("</" + tag + ">")
+
+            elif chunk_type == RES_XML_CDATA_TYPE:
+                if not states:  # 根节点之外的文本
+                    continue
+                if open_tag:
+                    out.append(">")
+                    open_tag = False
+                text = string_pool_get(struct.unpack_from("<I", buff, chunk + RES_CHUNK_HEADER_SIZE + 8)[0])
+                out.append(_escape_xml(INVALID_XML_CHARS.sub("", text), False))
+                states[-1] = 2
+
+            elif chunk_type == RES_XML_START_NAMESPACE_TYPE:
+                prefix, uri = self._get_ns_string(chunk.prefix), self._get_ns_string(chunk.uri)
+                pending_ns.append((prefix, uri))
+                prefixes.setdefault(uri, []).append(prefix)
+                attr_names.clear()
+
+            elif chunk_type == RES_XML_END_NAMESPACE_TYPE:
+                uri = self._get_ns_string(chunk.uri)
+                if prefixes.get(uri):
+                    prefixes[uri].pop()
+                attr_names.clear()
+
+            if len(out) >= WRITE_BUFFER_COUNT:
+                write("".join(out))
+                out = []
+
+        if open_tag:    # 没有正常结束的文件
+            out.append(">")
+        out.append("\n")
+        write("".join(out))
+
+    @staticmethod
+    def _get_prefix(uri:str, prefixes:Dict[str, List[str]], auto_prefixes:Dict[str, str], decls:Dict[str, str]) -> str:
+        '''
+        write_xml中查找uri对应的prefix，没有声明过的uri自动生成一个，并在当前节点上声明
         '''
-        return etree.tostring(self.node_ptr, encoding="utf-8").decode('utf-8')
+        stack = prefixes.get(uri)
+        if stack and stack[-1]:
+            return stack[-1]
+        prefix = auto_prefixes.get(uri)
+        if prefix is None:
+            prefix = auto_prefixes[uri] = "ns%d" % len(auto_prefixes)
+        decls[prefix] = uri
+        return prefix
+
+
+def _escape_xml(text:str, quote:bool) -> str:
+    '''
+    转义xml中的特殊字符，quote为True时按属性值转义(额外转义引号和换行等)
+    '''
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    if quote:
+        if '"' in text:
+            text = text.replace('"', "&quot;")
+        if "\n" in text:
+            text = text.replace("\n", "&#10;")
+        if "\r" in text:
+            text = text.replace("\r", "&#13;")
+        if "\t" in text:
+            text = text.replace("\t", "&#9;")
+    return text
 
 
 class Arsc(ResChunkHeader):
-    def __init__(self, buff: bytes, pre_decode:bool = True) -> None:
+    def __init__(self, buff: bytes, pre_decode:bool = False) -> None:
         super().__init__(buff)
         self.pre_decode = pre_decode
         self.package_count = struct.unpack("<I",self.buff[self.ptr: self.ptr + 4])[0]
@@ -991,6 +1797,8 @@ class Arsc(ResChunkHeader):
 
         self.string_pool:StringPool= None
         self.table_packages:Dict[int, ResTablePackage] = {}
+        # 全局字符串池和各个package的字符串池共用的驻留表
+        self.string_table = StringTable()
 
         while (self.ptr < self.size):
             # 读取完指定数量的package后，后面的是脏数据
@@ -1000,10 +1808,10 @@ class Arsc(ResChunkHeader):
             next_chunk_type = struct.unpack("<H", self.buff[self.ptr: self.ptr + 2])[0]
 
             if next_chunk_type == RES_STRING_POOL_TYPE:
-                self.string_pool = StringPool(self.buff[self.ptr:], pre_decode)
+                self.string_pool = StringPool(self.buff, pre_decode, self.ptr, table=self.string_table)
                 self._ptr_add(self.string_pool.size)
             elif next_chunk_type == RES_TABLE_PACKAGE_TYPE:
-                tmp_tp = ResTablePackage(self.buff[self.ptr:], self.string_pool)
+                tmp_tp = ResTablePackage(self.buff[self.ptr:], self.string_pool, self.string_table)
                 if (not self.table_packages.get(tmp_tp.id, None)):  # 不覆盖之前获取到的包，以第一个获取到的为准
                     self.table_packages[tmp_tp.id] = tmp_tp
                 self._ptr_add(tmp_tp.size)
@@ -1,17 +1,34 @@
-from copy import deepcopy
+from array import array
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 import os
 import struct
-from typing import Dict, List
+from typing import Callable, Dict, Iterator, List, Tuple, Union
 
 # 压缩算法
 import zlib
 import bz2
 import lzma
 
+# numpy可选，有numpy时批量解析中心目录
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from ApkParse.parser.range_reader import RangeReader, MmapRangeReader, FileRangeReader, CachedRangeReader, CACHE_SIZE
+
 import logging
 logger = logging.getLogger("apk_parse")
 
 END_CENTDIR_SIZE = 22   # end of central directory minimum size
+MAX_COMMENT_SIZE = 0xFFFF   # zip注释最大长度，文件尾只可能出现在最后 MAX_COMMENT_SIZE + END_CENTDIR_SIZE 字节内
+CHUNK_SIZE = 64 * 1024      # 流式读取时每次处理的数据大小
+LFH_EXTRA_SLACK = 64        # 读取local header时多读的字节数，local header的extra field长度可能和central dir中的不一样
+PREFETCH_GAP = 16 * 1024    # 预读时间隔小于此值的范围合并成一次读取
+MAX_ECD_TRIES = 4           # 最多尝试几个候选文件尾，防止大量伪造的文件尾导致反复解析中心目录
 CENTDIR_SIZE = 46       # central directory minimum size
 FILE_HEADER_SIZE = 30   # file header minimum size
 
@@ -19,6 +36,10 @@ END_CENTDIR_TAG = b"\x50\x4b\x05\x06"
 FILE_HEADER_TAG = b"\x50\x4b\x03\x04"
 CENTDIR_TAG = b"\x50\x4b\x01\x02"
 
+FLAG_UTF8 = 0x800           # general purpose bit flag: 文件名为utf-8编码
+ZIP_MAX_OFFSET = 0xFFFFFFFF # 不支持zip64
+ZIP_MAX_ENTRIES = 0xFFFF
+
 
 # apk只支持Deflated和Stored，额外两个以防万一，好像后续会支持bzip
 ZIP_STORED = 0
@@ -57,7 +78,7 @@ class CentralDirectory:
         self.extra_field:bytes = None
         self.comment:bytes = None
 
-        self.tag = buff[offset: offset + 4]
+        self.tag = bytes(buff[offset: offset + 4])
         if self.tag != CENTDIR_TAG:
             raise Exception("central dir header error!!")
         data = buff[offset + 4: offset + CENTDIR_SIZE]
@@ -82,9 +103,242 @@ class CentralDirectory:
         fname_end = offset + CENTDIR_SIZE + self.fname_len
         ex_field_end = fname_end + self.extra_field_len
         comment_end = ex_field_end + self.comment_len
-        self.file_name = buff[offset + CENTDIR_SIZE: fname_end]
-        self.extra_field = buff[fname_end: ex_field_end]
-        self.comment = buff[ex_field_end: comment_end]
+        self.file_name = bytes(buff[offset + CENTDIR_SIZE: fname_end])
+        self.extra_field = bytes(buff[fname_end: ex_field_end])
+        self.comment = bytes(buff[ex_field_end: comment_end])
+
+
+# 中心文件记录的固定部分, 包括签名
+CENTDIR_STRUCT = struct.Struct("<4s6H3I5H2I")
+# CentralDirectoryIndex只需要的字段: 签名, 压缩方法, crc, 两个大小, 三个变长字段长度, local header偏移
+CENTDIR_INDEX_STRUCT = struct.Struct("<4s6xH4x3I3H8xI")
+# 三个变长字段的长度
+CENTDIR_LENS_OFFSET = 28
+CENTDIR_LENS_STRUCT = struct.Struct("<3H")
+CENTDIR_TAG_INT = 0x02014b50
+
+if np is not None:
+    CENTDIR_DTYPE = np.dtype([
+        ("tag", "<u4"),
+        ("version_made_by", "<u2"),
+        ("version_need", "<u2"),
+        ("bit_flag", "<u2"),
+        ("method", "<u2"),
+        ("last_mod_time", "<u2"),
+        ("last_mod_date", "<u2"),
+        ("crc_32", "<u4"),
+        ("compressed_size", "<u4"),
+        ("uncompressed_size", "<u4"),
+        ("fname_len", "<u2"),
+        ("extra_field_len", "<u2"),
+        ("comment_len", "<u2"),
+        ("disk_num_start", "<u2"),
+        ("in_file_attr", "<u2"),
+        ("ex_file_attr", "<u4"),
+        ("local_header_off", "<u4"),
+    ])
+
+
+class CentralDirectoryIndex:
+    '''
+    列式保存的中心目录，条目很多的apk(几万个文件)为每个条目创建CentralDirectory对象太占内存，
+    这里只保存解压需要的几个字段，每个字段一个array，文件名不复制，只记录在buff中的位置
+
+    完整的CentralDirectory只在需要时通过 get_cd(row) 从原始数据重新解析
+    '''
+
+    def __init__(self, buff:bytes, offset:int, count:int) -> None:
+        '''
+        Args:
+            buff: 包含中心目录的数据
+            offset: 中心目录在buff中的偏移
+            count: 中心目录条目数
+        '''
+        self.buff = buff
+        self.count:int = 0
+        self.record_offs = array('I')           # 每条记录在buff中的偏移
+        self.methods = array('H')
+        self.crc_32s = array('I')
+        self.compressed_sizes = array('I')
+        self.uncompressed_sizes = array('I')
+        self.local_header_offs = array('I')
+        self.name_offs = array('I')             # 第row个文件名为 buff[name_offs[row]: name_ends[row]]
+        self.name_ends = array('I')
+        self._index:Dict[bytes, int] = {}
+        self._unique_names:List[bytes] = None   # 去重后的文件名，只列文件名时使用
+
+        if np is not None:
+            self._decode_numpy(buff, offset, count)
+        else:
+            self._decode_struct(buff, offset, count)
+        self.count = count
+
+    def _decode_struct(self, buff:bytes, offset:int, count:int) -> None:
+        '''
+        没有numpy时使用预编译的struct, 每条记录只unpack一次, 只取需要的字段
+        '''
+        unpack_from = CENTDIR_INDEX_STRUCT.unpack_from
+        record_offs_append = self.record_offs.append
+        methods_append = self.methods.append
+        crc_32s_append = self.crc_32s.append
+        compressed_sizes_append = self.compressed_sizes.append
+        uncompressed_sizes_append = self.uncompressed_sizes.append
+        local_header_offs_append = self.local_header_offs.append
+        name_offs_append = self.name_offs.append
+        name_ends_append = self.name_ends.append
+        index = self._index
+        for row in range(count):
+            (tag, method, crc_32, compressed_size, uncompressed_size,
+            fname_len, extra_field_len, comment_len, local_header_off) = unpack_from(buff, offset)
+            if tag != CENTDIR_TAG:
+                raise Exception("central dir header error!!")
+            name_off = offset + CENTDIR_SIZE
+            name_end = name_off + fname_len
+
+            record_offs_append(offset)
+            methods_append(method)
+            crc_32s_append(crc_32)
+            compressed_sizes_append(compressed_size)
+            uncompressed_sizes_append(uncompressed_size)
+            local_header_offs_append(local_header_off)
+            name_offs_append(name_off)
+            name_ends_append(name_end)
+            index[buff[name_off: name_end]] = row
+
+            offset += CENTDIR_SIZE + fname_len + extra_field_len + comment_len
+
+    def _decode_numpy(self, buff:bytes, offset:int, count:int) -> None:
+        '''
+        先用numpy在整段数据里找所有"PK\\x01\\x02"签名，作为每条记录的位置，
+        再用滑动窗口按行取出每条记录46字节的固定头部，按结构体批量解析；
+        签名不能首尾相接时(文件名里恰好包含签名、数据损坏)，退回逐条读取三个变长字段的长度来定位
+
+        文件名索引(self.index)在第一次查找文件时才创建，只列文件名的任务不需要它
+        '''
+        self._index = None
+        if count == 0:
+            return
+
+        raw = np.frombuffer(buff, dtype=np.uint8, offset=offset)
+        rel_offs = self._locate_numpy(raw, count)
+        if rel_offs is not None:
+            records = self._read_records(raw, rel_offs)
+            rec_ends = rel_offs + CENTDIR_SIZE + records["fname_len"] + records["extra_field_len"] \
+                        + records["comment_len"]
+            if not np.array_equal(rec_ends[:-1], rel_offs[1:]) or rec_ends[-1] > len(raw):
+                rel_offs = None
+
+        if rel_offs is None:
+            pos = offset
+            unpack_from = CENTDIR_LENS_STRUCT.unpack_from
+            record_offs = array('I')
+            record_offs_append = record_offs.append
+            for _ in range(count):
+                fname_len, extra_field_len, comment_len = unpack_from(buff, pos + CENTDIR_LENS_OFFSET)
+                record_offs_append(pos)
+                pos += CENTDIR_SIZE + fname_len + extra_field_len + comment_len
+            if pos > len(buff):
+                raise Exception("central dir header error!!")
+            rel_offs = np.frombuffer(record_offs, dtype=np.uint32).astype(np.intp) - offset
+            records = self._read_records(raw, rel_offs)
+            if np.any(records["tag"] != CENTDIR_TAG_INT):
+                raise Exception("central dir header error!!")
+
+        record_offs = rel_offs + offset
+        self.record_offs.frombytes(record_offs.astype(np.uint32).tobytes())
+        for field, arr in (("method", self.methods), ("crc_32", self.crc_32s),
+                           ("compressed_size", self.compressed_sizes),
+                           ("uncompressed_size", self.uncompressed_sizes),
+                           ("local_header_off", self.local_header_offs)):
+            arr.frombytes(records[field].astype(arr.typecode).tobytes())
+        name_offs = record_offs + CENTDIR_SIZE
+        self.name_offs.frombytes(name_offs.astype(np.uint32).tobytes())
+        self.name_ends.frombytes((name_offs + records["fname_len"]).astype(np.uint32).tobytes())
+        del raw, records
+
+    @staticmethod
+    def _read_records(raw, rel_offs):
+        '''
+        按行取出每条记录的固定头部，滑动窗口不复制数据，只复制取出的行
+        '''
+        windows = np.lib.stride_tricks.sliding_window_view(raw, CENTDIR_SIZE)
+        return windows[rel_offs].view(CENTDIR_DTYPE).reshape(-1)
+
+    @staticmethod
+    def _locate_numpy(raw, count:int):
+        '''
+        返回前count个签名相对raw的偏移，签名不够或者第一条记录不在开头时返回None
+        '''
+        if len(raw) < CENTDIR_SIZE:
+            return None
+        cand = np.flatnonzero(raw[:len(raw) - CENTDIR_SIZE + 1] == 0x50)
+        cand = cand[(raw[cand + 1] == 0x4b) & (raw[cand + 2] == 0x01) & (raw[cand + 3] == 0x02)]
+        if len(cand) < count or cand[0] != 0:
+            return None
+        return cand[:count]
+
+    @property
+    def index(self) -> Dict[bytes, int]:
+        '''
+        文件名 -> 行号，重名时以最后一个为准(和以前的dict行为一致)
+        '''
+        if self._index is None:
+            self._index = dict(zip(self.list_names(), range(self.count)))
+        return self._index
+
+    def list_names(self) -> List[bytes]:
+        '''
+        按中心目录中的顺序列出文件名，包括重名的文件
+        '''
+        buff = self.buff
+        return [buff[start: end] for start, end in zip(self.name_offs.tolist(), self.name_ends.tolist())]
+
+    def iter_names(self) -> Iterator[bytes]:
+        '''
+        按中心目录中的顺序遍历文件名，包括重名的文件
+        '''
+        return iter(self.list_names())
+
+    def unique_names(self) -> List[bytes]:
+        '''
+        和index.keys()顺序相同的文件名(重名的只保留第一次出现的位置)，不需要创建index，结果会缓存
+        '''
+        if self._unique_names is None:
+            if self._index is not None:
+                self._unique_names = list(self._index)
+            else:
+                names = self.list_names()
+                self._unique_names = names if len(set(names)) == len(names) else list(dict.fromkeys(names))
+        return self._unique_names
+
+    def name_at(self, row:int) -> bytes:
+        return self.buff[self.name_offs[row]: self.name_ends[row]]
+
+    def get_cd(self, row:int) -> CentralDirectory:
+        return CentralDirectory(self.buff, self.record_offs[row])
+
+
+class CentralDirectoryView(Mapping):
+    '''
+    兼容以前的 ZipFile.cds 字典: {文件名: CentralDirectory}
+    读取时才创建CentralDirectory对象，不做缓存
+    '''
+
+    def __init__(self, cd_index:CentralDirectoryIndex) -> None:
+        self.cd_index = cd_index
+
+    def __getitem__(self, file_name:bytes) -> CentralDirectory:
+        return self.cd_index.get_cd(self.cd_index.index[file_name])
+
+    def __contains__(self, file_name) -> bool:
+        return file_name in self.cd_index.index
+
+    def __iter__(self) -> Iterator[bytes]:
+        # 只遍历文件名时直接读取列，不创建文件名索引
+        return iter(self.cd_index.unique_names())
+
+    def __len__(self) -> int:
+        return len(self.cd_index.unique_names())
 
 
 class LocalFileHeader:
@@ -102,17 +356,27 @@ class LocalFileHeader:
     # file name (variable size)
     # extra field (variable size)
 
-    def __init__(self, buff:bytes, cd:CentralDirectory) -> None:
+    def __init__(self, buff:bytes, cd:CentralDirectory, offset:int = None) -> None:
+        '''
+        Args:
+            buff: 包含local file header的数据
+            cd: 对应的central dir
+            offset: local file header在buff中的偏移，默认为cd.local_header_off，即buff为整个文件的数据
+        '''
         # 下面三个属性应该都是字符串，
         # 但是防止恶意软件使用异常的字符进行对抗，还是用二进制保存
         self.file_name:bytes = None
         self.extra_field:bytes = None
-        self.file_data:bytes = None
+        # file_data是buff上的memoryview，不复制数据，用完需要release，否则mmap无法关闭
+        # buff中没有包含完整数据时，file_data也是不完整的; ZipFile缓存header时会把它取走，置为None
+        self.file_data:memoryview = None
 
-        self.tag = buff[cd.local_header_off: cd.local_header_off + 4]
+        if offset is None:
+            offset = cd.local_header_off
+        self.tag = bytes(buff[offset: offset + 4])
         if self.tag != FILE_HEADER_TAG:
             raise Exception("local file header error!!")
-        data = buff[cd.local_header_off + 4 : cd.local_header_off + FILE_HEADER_SIZE]
+        data = buff[offset + 4 : offset + FILE_HEADER_SIZE]
 
         (self.version_need,
         self.bit_flag,
@@ -125,25 +389,36 @@ class LocalFileHeader:
         self.fname_len,
         self.extra_field_len) = struct.unpack("<5H3I2H", data)
 
-        file_name_end = cd.local_header_off + FILE_HEADER_SIZE + self.fname_len
+        file_name_end = offset + FILE_HEADER_SIZE + self.fname_len
         
         # 这里非常怪，extra field的长度使用的LocalFileHeader自己保存的长度，
         # 而compressed_size使用的却是central dir中保存的长度，懒得翻源码了，
         # 也可能是谷歌默认extra field就为0，根本就没读取这部分数据,这里先按LFH保存的长度读取，出错了再说
         extra_field_end = file_name_end + self.extra_field_len
+        self.header_size:int = FILE_HEADER_SIZE + self.fname_len + self.extra_field_len
 
         # 下面是安卓源码中计算解压前数据长度的方法，只要方法不等于deflated，就当作stored处理
         # 如果是stored方式，则解压前的数据长度以uncompressed_size为准
         # （这里感觉莫名其妙，为啥不统一用compressed_size去解压？故意搞复杂然后方便恶意app利用这点，使第三方解析工具解析报错？
         # 都不说第三方了，谷歌官方的apk解析工具都报错。。只有android系统里面的源码是用的这种奇怪的判定方式）
-        if cd.compression_method != ZIP_DEFLATED:
-            file_data_end = extra_field_end + cd.uncompressed_size
-        else:
-            file_data_end = extra_field_end + cd.compressed_size
+        self.data_size:int = local_data_size(cd)
+        # 数据在整个文件中的偏移
+        self.data_offset:int = cd.local_header_off + self.header_size
 
-        self.file_name = buff[cd.local_header_off + FILE_HEADER_SIZE: file_name_end]
-        self.extra_field = buff[file_name_end : extra_field_end]
-        self.file_data = buff[extra_field_end : file_data_end]
+        self.file_name = bytes(buff[offset + FILE_HEADER_SIZE: file_name_end])
+        self.extra_field = bytes(buff[file_name_end : extra_field_end])
+        self.data_start:int = extra_field_end
+        self.data_end:int = min(extra_field_end + self.data_size, len(buff))
+        self.file_data = memoryview(buff)[self.data_start: self.data_end]
+
+
+def local_data_size(cd:CentralDirectory) -> int:
+    '''
+    按安卓的规则计算local file header后面的数据长度，不是deflated的都按stored处理，长度为uncompressed_size
+    '''
+    if cd.compression_method != ZIP_DEFLATED:
+        return cd.uncompressed_size
+    return cd.compressed_size
     
 
 class EndOfCentralDirectory:
@@ -162,13 +437,19 @@ class EndOfCentralDirectory:
     # .ZIP file comment length        2 bytes
     # .ZIP file comment       (variable size)
 
-    def __init__(self, buff:bytes, offset:int) -> None:
+    def __init__(self, buff:bytes, offset:int, file_offset:int = 0) -> None:
+        '''
+        Args:
+            buff: 包含文件尾的数据
+            offset: 文件尾在buff中的偏移
+            file_offset: 文件尾在整个文件中的偏移
+        '''
         self.tag = buff[offset: offset + 4]
         if self.tag != END_CENTDIR_TAG:
             raise Exception("Not Zip File")
+        self.file_offset:int = file_offset
 
         data = buff[offset + 4: offset + END_CENTDIR_SIZE]
-        self.comment = buff[offset + END_CENTDIR_SIZE: ]
 
         (self.num_disk, 
         self.num_disk_start, 
@@ -178,8 +459,76 @@ class EndOfCentralDirectory:
         self.central_dir_offset, 
         self.comment_size) = struct.unpack("<4H2IH",data)
 
-        if len(self.comment) != self.comment_size:
-            logging.warning("EndOfCentralDirectory comment length error !!")
+        # 伪造的文件尾可能非常多，注释按需切片，避免每个候选都复制一遍尾部数据
+        self._buff = buff
+        self._comment_start = offset + END_CENTDIR_SIZE
+        self.comment_ok:bool = len(buff) - self._comment_start == self.comment_size
+
+    @property
+    def comment(self) -> bytes:
+        return self._buff[self._comment_start: self._comment_start + self.comment_size]
+
+    def plausibility(self, tail:bytes = b"", tail_start:int = 0) -> int:
+        '''
+        文件尾的可信程度打分，分数越高越可能是真正的文件尾
+
+        恶意apk可能在注释或文件末尾插入多个伪造的 504b0506，这里只做简单的一致性检查，
+        中心目录的签名只在中心目录开头位于tail中时检查，避免额外的读取
+
+        Args:
+            tail: 文件尾部的数据
+            tail_start: tail在文件中的偏移
+        '''
+        score = 0
+        cd_end = self.central_dir_offset + self.central_dir_size
+        if cd_end <= self.file_offset:      # 中心目录在文件尾之前，正常的zip中心目录紧挨着文件尾
+            score += 8 if cd_end == self.file_offset else 4
+            tag_pos = self.central_dir_offset - tail_start
+            if self.entries_num_all == 0 or tag_pos < 0 or tag_pos + 4 > len(tail) \
+                    or tail[tag_pos: tag_pos + 4] == CENTDIR_TAG:
+                score += 4
+        if self.entries_num_all * CENTDIR_SIZE <= self.central_dir_size:   # 条目数与中心目录大小匹配
+            score += 2
+        if self.entries_num_this == self.entries_num_all:
+            score += 1
+        if self.comment_ok:
+            score += 1
+        return score
+
+
+def find_end_of_central_dirs(buff:bytes, file_size:int) -> List[EndOfCentralDirectory]:
+    '''
+    只在文件最后 64KiB + 22 字节内查找文件尾(只复制这一段数据)，返回全部候选，按可信程度从高到低排序
+
+    Args:
+        buff: 整个文件的数据, 支持bytes和mmap, 只会切片访问尾部
+        file_size: 文件大小
+    '''
+    tail_start = max(0, file_size - MAX_COMMENT_SIZE - END_CENTDIR_SIZE)
+    return locate_end_of_central_dirs(bytes(buff[tail_start: file_size]), tail_start)
+
+
+def locate_end_of_central_dirs(tail:bytes, tail_start:int) -> List[EndOfCentralDirectory]:
+    '''
+    在文件尾部数据中查找全部候选文件尾，按可信程度从高到低排序，
+    分数相同时越靠后的越优先(和之前只取最后一个完整文件尾的逻辑一致)
+
+    Args:
+        tail: 文件最后 64KiB + 22 字节的数据
+        tail_start: tail在文件中的偏移
+    '''
+    candidates = []
+    end = len(tail) - END_CENTDIR_SIZE + 4   # 文件尾不足22字节的匹配直接跳过
+    while end >= 4:
+        pos = tail.rfind(END_CENTDIR_TAG, 0, end)
+        if pos == -1:
+            break
+        ecd = EndOfCentralDirectory(tail, pos, tail_start + pos)
+        candidates.append((ecd.plausibility(tail, tail_start), pos, ecd))
+        end = pos + 3
+
+    candidates.sort(key=lambda x: (x[0], x[1]), reverse=True)
+    return [ecd for _, _, ecd in candidates]
 
 
 class LZMADecompressor:
@@ -248,83 +597,485 @@ def _get_decompressor(compress_type:int):
             raise NotImplementedError("compression type %d" % (compress_type,))
 
 
-class ZipFile:
+class ZipEntrySizeError(Exception):
+    '''
+    解压后的数据超过了指定的上限，可能是zip炸弹
+    '''
+
+
+class ZipEntryReader:
+    '''
+    流式读取单个文件，按块解压，内存占用与文件大小无关
+
+    可以像文件一样read()，也可以直接迭代，每次得到一块解压后的数据:
+        with zip_file.open_entry(b"classes.dex") as fr:
+            for chunk in fr:
+                sha1.update(chunk)
+    '''
+
+    def __init__(self, read:Callable[[int, int], bytes], lf:LocalFileHeader, method:int,
+                 chunk_size:int = CHUNK_SIZE, max_size:int = None) -> None:
+        '''
+        Args:
+            read: 读取数据的函数 read(offset, length)，压缩数据按块读取
+            lf: 文件对应的LocalFileHeader，数据位置和长度按安卓的规则计算
+            method: central dir中保存的压缩方法，不是ZIP_DEFLATED的都当作stored处理
+            chunk_size: 每次读取的压缩数据大小，同时也是迭代时每块解压数据的最大长度
+            max_size: 解压后数据的最大长度，超过时抛出ZipEntrySizeError，为None时不限制
+        '''
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.out_size = 0           # 已经输出的数据长度
+        self._read = read
+        self._pos = lf.data_offset
+        self._end = lf.data_offset + lf.data_size
+        self._closed = False
+        self._decomp = zlib.decompressobj(-15) if method == ZIP_DEFLATED else None
+        self._pending = b""         # read(size)多解压出来的数据
+        # 当前正在处理的输入数据，mmap等读取方式返回的是memoryview，用完马上release，
+        # 否则异常的traceback等还引用着它时，ZipFile.close()无法关闭mmap
+        self._view:memoryview = None
+
+    def _release_view(self) -> None:
+        if isinstance(self._view, memoryview):
+            self._view.release()
+        self._view = None
+
+    def _next_chunk(self, size:int) -> bytes:
+        '''
+        返回最多size字节的数据，读完时返回b""
+        '''
+        if self._closed:
+            raise ValueError("read from closed entry")
+        if self._decomp is None:
+            self._view = self._read(self._pos, min(size, self._end - self._pos))
+            chunk = bytes(self._view)
+            self._release_view()
+            self._pos += len(chunk)
+        else:
+            chunk = b""
+            while not chunk:
+                if self._decomp.eof:
+                    break
+                if self._decomp.unconsumed_tail:
+                    in_data = self._decomp.unconsumed_tail
+                elif self._pos < self._end:
+                    in_data = self._view = self._read(self._pos, min(self.chunk_size, self._end - self._pos))
+                    if not in_data:     # 文件不完整
+                        self._end = self._pos
+                        continue
+                    self._pos += len(in_data)
+                else:
+                    # 输入已经读完，zlib内部可能还有因为max_length没输出的数据
+                    chunk = self._decomp.decompress(b"", size)
+                    break
+                # 和以前一次性解压一样，数据不完整时只返回能解压出来的部分，不报错
+                chunk = self._decomp.decompress(in_data, size)
+                self._release_view()   # 没有解压完的部分在unconsumed_tail中，是复制出来的
+
+        self.out_size += len(chunk)
+        if self.max_size is not None and self.out_size > self.max_size:
+            raise ZipEntrySizeError(f"entry size exceeds limit {self.max_size}")
+        return chunk
+
+    def read(self, size:int = -1) -> bytes:
+        if size is None or size < 0:
+            return b"".join(list(self))
+
+        res = [self._pending]
+        got = len(self._pending)
+        while got < size:
+            chunk = self._next_chunk(max(size - got, self.chunk_size))
+            if not chunk:
+                break
+            res.append(chunk)
+            got += len(chunk)
+        data = b"".join(res)
+        self._pending = data[size:]
+        return data[:size]
+
+    def __iter__(self) -> Iterator[bytes]:
+        if self._pending:
+            chunk, self._pending = self._pending, b""
+            yield chunk
+        while True:
+            chunk = self._next_chunk(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self) -> None:
+        self._closed = True
+        self._release_view()
+        self._decomp = None
+        self._pending = b""
+
+    def __enter__(self) -> "ZipEntryReader":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+
+class ZipWriter:
+    '''
+    写一个标准的zip文件(不支持zip64)，只写入已经压缩好的数据，不负责压缩
+
+    local header中的大小、crc等字段都和central dir保持一致，不使用data descriptor
+    '''
+
     def __init__(self, fpath:str) -> None:
+        self.fpath = fpath
+        self._fw = open(fpath, 'wb')
+        self._offset = 0
+        self._cd_records:List[bytes] = []
+
+    def write_raw(self, file_name:bytes, data:bytes, method:int, crc_32:int, uncompressed_size:int,
+                  last_mod_time:int = 0, last_mod_date:int = 0x21, bit_flag:int = 0,
+                  ex_file_attr:int = 0, align:int = 0) -> None:
+        '''
+        写入一个已经压缩好的文件
+
+        Args:
+            file_name: 文件名
+            data: 压缩后的数据，stored时就是原始数据
+            method: ZIP_STORED 或 ZIP_DEFLATED
+            crc_32: 原始数据的crc
+            uncompressed_size: 原始数据长度
+            bit_flag: 只保留utf-8文件名标志，其他标志都会去掉
+            align: stored文件的数据按此字节数对齐(和zipalign一样用extra field填充)，为0时不对齐
+        '''
+        if self._offset > ZIP_MAX_OFFSET or len(self._cd_records) >= ZIP_MAX_ENTRIES:
+            raise Exception("zip64 is not supported")
+
+        bit_flag &= FLAG_UTF8
+        version_need = 20 if method == ZIP_DEFLATED else 10
+        compressed_size = len(data)
+
+        extra_field = b""
+        if align and method == ZIP_STORED:
+            data_start = self._offset + FILE_HEADER_SIZE + len(file_name)
+            extra_field = b"\x00" * ((align - data_start % align) % align)
+
+        header = struct.pack("<4s5H3I2H", FILE_HEADER_TAG, version_need, bit_flag, method,
+                    last_mod_time, last_mod_date, crc_32, compressed_size, uncompressed_size,
+                    len(file_name), len(extra_field))
+        self._cd_records.append(struct.pack("<4s6H3I5H2I", CENTDIR_TAG, version_need, version_need,
+                    bit_flag, method, last_mod_time, last_mod_date, crc_32, compressed_size,
+                    uncompressed_size, len(file_name), 0, 0, 0, 0, ex_file_attr, self._offset) + file_name)
+
+        self._fw.write(header)
+        self._fw.write(file_name)
+        self._fw.write(extra_field)
+        self._fw.write(data)
+        self._offset += len(header) + len(file_name) + len(extra_field) + compressed_size
+
+    def close(self) -> None:
+        '''
+        写入中心目录和文件尾
+        '''
+        if self._fw is None:
+            return
+        cd_offset = self._offset
+        cd_size = 0
+        for record in self._cd_records:
+            self._fw.write(record)
+            cd_size += len(record)
+        if cd_offset > ZIP_MAX_OFFSET or cd_size > ZIP_MAX_OFFSET:
+            raise Exception("zip64 is not supported")
+        count = len(self._cd_records)
+        self._fw.write(struct.pack("<4s4H2IH", END_CENTDIR_TAG, 0, 0, count, count, cd_size, cd_offset, 0))
+        self._fw.close()
+        self._fw = None
+
+    def __enter__(self) -> "ZipWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is not None and self._fw is not None:
+            self._fw.close()
+            self._fw = None
+            return
+        self.close()
+
+
+class ZipFile:
+    def __init__(self, fpath:Union[str, RangeReader], use_mmap:bool = True, cache_size:int = CACHE_SIZE) -> None:
+        '''
+        Args:
+            fpath: apk文件路径，或者RangeReader(从任意位置按范围读取数据，如对象存储)
+            use_mmap: 本地文件使用mmap映射, 默认开启, 只有实际读取到的数据才会占用内存,
+                关闭时每次读取都直接读文件
+            cache_size: 不是mmap等零复制的读取方式时，按块缓存读取过的数据，此值为缓存的最大字节数，为0时不缓存
+        '''
         self.is_init = False    # 无严重错误时, 此值为True, 为False很可能因为文件不是apk
-        self.fhs:Dict[bytes,LocalFileHeader] = {}    # file headers
-        self.cds:Dict[bytes,CentralDirectory] = {}    # central directories
+        self.fhs:Dict[bytes,LocalFileHeader] = {}    # file headers, 只缓存解析出的头部，不保存数据
+        self.cds:Dict[bytes,CentralDirectory] = {}    # central directories, 实际为CentralDirectoryView, 按需创建
+        self.cd_index:CentralDirectoryIndex = None    # 列式保存的中心目录
         self.ecd:EndOfCentralDirectory = None   # end of central directory
 
-        self.file_path:str = fpath
-        self.file_size:int = os.path.getsize(fpath)
-        try:
-            fpin = open(fpath, 'rb')
-        except Exception as e:
-            logger.error(f'Can not read file: {fpath}')
-            return
-        self.file_data:bytes = fpin.read()
+        self.reader:RangeReader = None
+        if isinstance(fpath, (str, os.PathLike)):
+            self.file_path:str = fpath
+            try:
+                self.reader = MmapRangeReader(fpath) if use_mmap else FileRangeReader(fpath)
+            except Exception as e:
+                logger.error(f'Can not read file: {fpath}, {e}')
+                return
+        else:
+            self.reader = fpath
+            self.file_path:str = getattr(fpath, "path", "")
+        if cache_size > 0 and not self.reader.zero_copy and not isinstance(self.reader, CachedRangeReader):
+            self.reader = CachedRangeReader(self.reader, cache_size)
+        self.file_size:int = self.reader.size
 
-        # 获取zip尾部信息
-        data = deepcopy(self.file_data)
-        
-        # 从后往前读取第一个长度满足条件的文件尾
-        try:
-            end_len = 0
-            while(end_len < 22):
-                if end_len != 0:
-                    data = data[:-end_len]
-                ecd_start = data.rfind(END_CENTDIR_TAG)
-                if ecd_start == -1:
-                    raise Exception("file incomplete.")
-                end_len = len(data[ecd_start:])
-                
-            self.ecd = EndOfCentralDirectory(data, ecd_start)
-        except Exception as e:
-            logger.error(f'Not Zip File, {e}')
+        # 获取zip尾部信息, 只读取文件最后64KiB，按可信程度依次尝试每个候选文件尾
+        tail_start = max(0, self.file_size - MAX_COMMENT_SIZE - END_CENTDIR_SIZE)
+        tail = bytes(self._read(tail_start, self.file_size - tail_start))
+        ecds = locate_end_of_central_dirs(tail, tail_start)
+        if not ecds:
+            logger.error(f'Not Zip File, file incomplete.')
             return
 
-        # 获取中心文件记录
-        data = self.file_data[self.ecd.central_dir_offset:]
-        cd_count = 0
-        offset = 0
-        try:
-            while(cd_count < self.ecd.entries_num_all):
-                cd_count += 1
-                tmp_cd = CentralDirectory(data, offset)
-                offset += tmp_cd.fname_len + tmp_cd.extra_field_len \
-                        + tmp_cd.comment_len + CENTDIR_SIZE
-                self.cds[tmp_cd.file_name] = tmp_cd
-        except Exception as e:
-            logger.error(f"Read central dir error: {e}")
+        for ecd in ecds[:MAX_ECD_TRIES]:
+            try:
+                self.cd_index = self._read_central_dir(ecd, tail, tail_start)
+                self.cds = CentralDirectoryView(self.cd_index)
+            except Exception as e:
+                # 候选的文件尾可能是伪造的(如在注释中)，后面的候选成功时不算错误
+                logger.debug(f"Read central dir error at {ecd.file_offset}: {e}")
+                continue
+            self.ecd = ecd
+            break
+        else:
+            logger.error(f"Read central dir error, tried {min(len(ecds), MAX_ECD_TRIES)} end of central dirs")
             return
-        
+
+        if not self.ecd.comment_ok:
+            logger.warning("EndOfCentralDirectory comment length error !!")
+
         # 基础解析完成
         self.is_init = True
         # 初始化只获取尾部和中心文件记录的数据（504b0506和504b0102），
         # local file header通过central dir中指定的偏移，按需查找
         # 因为local file header之间可以随意插入任何数据
-        
+
+    def _read_central_dir(self, ecd:EndOfCentralDirectory, tail:bytes, tail_start:int) -> CentralDirectoryIndex:
+        '''
+        一次性读取整个中心目录，中心目录在tail中时直接使用tail，不再读取
+
+        中心目录的范围以文件尾中的大小为准，通常中心目录紧挨着文件尾，这里读到两者中较大的位置；
+        按这个范围解析出错时(大小被篡改)，再读到文件末尾重新解析一次
+        '''
+        cd_start = ecd.central_dir_offset
+        cd_end = max(cd_start + ecd.central_dir_size, ecd.file_offset)
+        if cd_start >= tail_start:
+            cd_buff = tail[cd_start - tail_start: cd_end - tail_start]
+        else:
+            cd_buff = bytes(self._read(cd_start, cd_end - cd_start))
+        try:
+            return CentralDirectoryIndex(cd_buff, 0, ecd.entries_num_all)
+        except Exception:
+            if cd_start + len(cd_buff) >= self.file_size:
+                raise
+        cd_buff = bytes(self._read(cd_start, self.file_size - cd_start))
+        return CentralDirectoryIndex(cd_buff, 0, ecd.entries_num_all)
+
+    def _read(self, offset:int, length:int) -> bytes:
+        return self.reader.read(offset, length)
+
+    def prefetch(self, file_names:List[bytes], max_gap:int = PREFETCH_GAP) -> None:
+        '''
+        预读指定文件的local file header和数据放入块缓存，相邻的文件合并成一次读取，
+        用于远程读取时减少请求次数，mmap等本地数据或者没有缓存时不需要预读
+
+        Args:
+            file_names: 文件名列表，不存在的文件会被忽略
+            max_gap: 间隔小于此值的文件合并读取
+        '''
+        if not isinstance(self.reader, CachedRangeReader):
+            return
+        ranges = []
+        for file_name in file_names:
+            if not self.has_file(file_name):
+                continue
+            cd = self.cds[file_name]
+            ranges.append((cd.local_header_off, FILE_HEADER_SIZE + cd.fname_len
+                            + cd.extra_field_len + LFH_EXTRA_SLACK + local_data_size(cd)))
+        self.reader.read_ranges(ranges, max_gap)
+
+    def _get_local_file_header(self, cd:CentralDirectory, with_data:bool = True) -> Tuple[LocalFileHeader, memoryview]:
+        '''
+        读取local file header，with_data为True时同时返回数据，用完需要release
+
+        解析过的header缓存在self.fhs中(不含数据)，再次读取时只读数据；
+        第一次读取时header和数据一次读取，local header中extra field的长度可能和central dir中的不一样，
+        先按central dir的长度多读一点，不够时再按实际长度读取一次
+
+        return:
+            (LocalFileHeader, 数据)，with_data为False时数据为None
+        '''
+        lf = self.fhs.get(cd.file_name)
+        if lf is not None:
+            if not with_data:
+                return lf, None
+            return lf, memoryview(self._read(lf.data_offset, lf.data_size))
+
+        data_size = local_data_size(cd) if with_data else 0
+        buff = self._read(cd.local_header_off, FILE_HEADER_SIZE + cd.fname_len
+                            + cd.extra_field_len + LFH_EXTRA_SLACK + data_size)
+        lf = LocalFileHeader(buff, cd, 0)
+        need = lf.header_size + data_size
+        if need > len(buff) and cd.local_header_off + len(buff) < self.file_size:
+            lf.file_data.release()
+            buff = self._read(cd.local_header_off, need)
+            lf = LocalFileHeader(buff, cd, 0)
+        file_data, lf.file_data = lf.file_data, None
+        self.fhs[cd.file_name] = lf
+        if not with_data:
+            file_data.release()
+            return lf, None
+        return lf, file_data
+
+    def close(self) -> None:
+        '''
+        关闭文件(释放mmap)，关闭后不能再读取文件
+        '''
+        self.fhs.clear()
+        if self.reader is not None:
+            self.reader.close()
+
+    def __enter__(self) -> "ZipFile":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
 
     def get_file(self, file_name:bytes) -> bytes:
         '''通过文件名获取文件
         '''
         cd = self.cds[file_name]
-        lf = LocalFileHeader(self.file_data, cd)
+        _, file_data = self._get_local_file_header(cd)
 
         # 解压时用的central dir 中保存的解压方法
-        return self._decompress(lf.file_data, cd.compression_method)
+        try:
+            return self._decompress(file_data, cd.compression_method)
+        finally:
+            file_data.release()
+
+    def open_entry(self, file_name:bytes, chunk_size:int = CHUNK_SIZE, max_size:int = None) -> ZipEntryReader:
+        '''
+        流式读取文件，不会一次性把整个文件解压到内存中，用完需要close
+
+        Args:
+            file_name: 文件名
+            chunk_size: 每次处理的数据大小
+            max_size: 解压后数据的最大长度，超过时抛出ZipEntrySizeError
+        '''
+        cd = self.cds[file_name]
+        lf, _ = self._get_local_file_header(cd, with_data=False)
+        return ZipEntryReader(self._read, lf, cd.compression_method, chunk_size, max_size)
 
     def has_file(self, file_name:bytes) -> bool:
+        # 初始化失败时没有中心目录
+        return self.cd_index is not None and file_name in self.cd_index.index
+
+    def re_zip(self, out_path:str, align:int = 4, recompress:bool = False,
+               level:int = 6, workers:int = None) -> None:
+        '''
+        重新写一个标准的zip文件，默认压缩过的数据直接复制，不解压也不重新压缩
+
+        按安卓的规则修复各种对抗：
+          - 压缩方法不是deflated的都按stored写入，数据长度以central dir中的uncompressed_size为准
+          - local header的大小、crc、文件名都使用central dir中的值，去掉local header的extra field和data descriptor
+          - 重名文件只保留一个(和cds一致)，去掉加密等无关的标志位
+          - stored文件的crc重新计算
+
+        recompress为True时，全部文件解压后在线程池中重新压缩(统一压缩等级，或者修复损坏的压缩数据)，
+        压缩数据损坏的文件只保留能解压出来的部分，crc和大小全部重新计算，写入顺序保持不变
+
+        Args:
+            out_path: 输出的文件
+            align: stored文件的对齐字节数，和zipalign一样默认4字节，为0时不对齐
+            recompress: 是否重新压缩
+            level: 重新压缩时的zlib压缩等级
+            workers: 重新压缩时的线程数，默认为cpu核数
+        '''
+        with ZipWriter(out_path) as writer:
+            if recompress:
+                self._re_zip_recompress(writer, align, level, workers)
+                return
+
+            for file_name in self.cds.keys():
+                cd = self.cds[file_name]
+                try:
+                    _, file_data = self._get_local_file_header(cd)
+                except Exception as e:
+                    logger.warning(f"re_zip: skip {file_name}, {e}")
+                    continue
+                try:
+                    if cd.compression_method == ZIP_DEFLATED:
+                        writer.write_raw(file_name, file_data, ZIP_DEFLATED, cd.crc_32, cd.uncompressed_size,
+                                cd.last_mod_time, cd.last_mod_date, cd.bit_flag, cd.ex_file_attr, align)
+                    else:
+                        writer.write_raw(file_name, file_data, ZIP_STORED, zlib.crc32(file_data),
+                                len(file_data), cd.last_mod_time, cd.last_mod_date, cd.bit_flag,
+                                cd.ex_file_attr, align)
+                finally:
+                    file_data.release()
+
+    def _re_zip_recompress(self, writer:ZipWriter, align:int, level:int, workers:int) -> None:
+        '''
+        多线程重新压缩，zlib压缩时会释放GIL；按顺序取结果写入，同时最多只有workers*2个文件在内存中
+        '''
+        if workers is None:
+            workers = os.cpu_count() or 1
+        file_names = iter(self.cds.keys())
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = deque(executor.submit(self._recompress_entry, name, level)
+                            for name in islice(file_names, workers * 2))
+            while futures:
+                res = futures.popleft().result()
+                for name in islice(file_names, 1):
+                    futures.append(executor.submit(self._recompress_entry, name, level))
+                if res is None:
+                    continue
+                file_name, data, method, crc_32, uncompressed_size, cd = res
+                writer.write_raw(file_name, data, method, crc_32, uncompressed_size,
+                        cd.last_mod_time, cd.last_mod_date, cd.bit_flag, cd.ex_file_attr, align)
+
+    def _recompress_entry(self, file_name:bytes, level:int) -> tuple:
+        '''
+        流式解压并重新压缩单个文件，原本是stored的文件依然用stored保存
+
+        return:
+            (file_name, 压缩后的数据, 压缩方法, crc, 原始长度, CentralDirectory)，读取失败时返回None
+        '''
+        cd = self.cds[file_name]
+        method = ZIP_DEFLATED if cd.compression_method == ZIP_DEFLATED else ZIP_STORED
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15) if method == ZIP_DEFLATED else None
+        crc_32 = 0
+        uncompressed_size = 0
+        out = []
         try:
-            self.cds[file_name]
-        except KeyError as e:
-            return False
-        return True
+            with self.open_entry(file_name) as fr:
+                try:
+                    for chunk in fr:
+                        crc_32 = zlib.crc32(chunk, crc_32)
+                        uncompressed_size += len(chunk)
+                        out.append(compressor.compress(chunk) if compressor else chunk)
+                except zlib.error as e:
+                    logger.warning(f"re_zip: {file_name} compressed data error, keep {uncompressed_size} bytes, {e}")
+        except Exception as e:
+            logger.warning(f"re_zip: skip {file_name}, {e}")
+            return None
+        if compressor:
+            out.append(compressor.flush())
+        return file_name, b"".join(out), method, crc_32, uncompressed_size, cd
 
-    def _decompress(self, buff:bytes, method:int):
+    def _decompress(self, buff:memoryview, method:int) -> bytes:
         if method != 8:
-            return buff
+            return bytes(buff)
         decompressor = _get_decompressor(method)
         
         return decompressor.decompress(buff)
-
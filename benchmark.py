@@ -1,14 +1,25 @@
 import os,sys
 from cProfile import Profile
 import datetime
+import resource
+import tempfile
+import time
+import tracemalloc
 from types import FunctionType
+import zipfile
 
 SELF_PATH = os.path.dirname(os.path.realpath(__file__))
+from ApkParse.parser import zip_parser
 from ApkParse.parser.zip_parser import ZipFile
 from ApkParse.main import ApkFile
-from androguard.core.bytecodes.apk import APK
+# 只有和androguard对比时需要
+try:
+    from androguard.core.bytecodes.apk import APK
+except ImportError:
+    APK = None
 
 test_apk = os.path.join(SELF_PATH, "test/apks/app-debug.apk")
+mix_apk = os.path.join(SELF_PATH, "test/apks/mix.apk")     # 46901个文件
 
 # 与androguard库简单对比，确保不要有很大的性能差距
 
@@ -64,11 +75,81 @@ def basic(target):
         version = a.get_androidversion_name()
         main_ac = a.get_main_activity()
         res = [appname, version, pkg, '', '', main_ac]
-    else:
+    elif target == 2:
         a = ApkFile(test_apk)
         res = a.get_basic_info()
+    else:
+        # 只取包名和版本号
+        a = ApkFile(test_apk, lazy=True)
+        res = [a.get_package(), a.get_version()]
+
+def zip_open(apk_path:str=mix_apk, legacy:bool=False):
+    '''
+    打开zip的耗时和内存，legacy为True时额外为每个条目创建CentralDirectory对象，即以前ZipFile.cds的保存方式
+    '''
+    tracemalloc.start()
+    start = time.perf_counter()
+    zip_file = ZipFile(apk_path)
+    if legacy:
+        cds = dict(zip_file.cds.items())
+    cost = time.perf_counter() - start
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"{'legacy' if legacy else 'index'}: entries:{len(zip_file.cds)}, time:{cost*1000:.1f}ms, "
+          f"python mem:{size/1024/1024:.2f}MB, peak:{peak/1024/1024:.2f}MB, max rss:{rss/1024:.1f}MB")
+
+def make_many_entries_zip(count:int) -> str:
+    '''
+    生成有count个空文件的zip，放在临时目录中，已经存在时直接使用
+    '''
+    zip_path = os.path.join(tempfile.gettempdir(), f"apkparse_bench_{count}.zip")
+    if not os.path.exists(zip_path):
+        with zipfile.ZipFile(zip_path + ".tmp", "w") as zf:
+            for i in range(count):
+                zf.writestr(f"res/drawable-xxhdpi-v4/icon_{i:06d}.png", b"")
+        os.replace(zip_path + ".tmp", zip_path)
+    return zip_path
+
+def central_dir(count:int = 50000, repeat:int = 7):
+    '''
+    打开中心目录有count个条目的zip的耗时，取repeat次中最快的一次，
+    分别测试有numpy和没有numpy(使用struct)两种解析方式，每种都测三项：
+      open: 只打开zip
+      list: 打开并遍历全部文件名(cds.keys())，不需要文件名索引
+      lookup: 打开并查找一个文件(第一次查找时建立文件名索引)，即端到端的耗时
+    '''
+    zip_path = make_many_entries_zip(count)
+    np = zip_parser.np
+    for mode in ("numpy", "struct"):
+        if mode == "numpy" and np is None:
+            print("numpy: not installed")
+            continue
+        zip_parser.np = np if mode == "numpy" else None
+        costs = {"open": float("inf"), "list": float("inf"), "lookup": float("inf")}
+        for _ in range(repeat):
+            for task in costs:
+                start = time.perf_counter()
+                zip_file = ZipFile(zip_path)
+                if task == "list":
+                    names = list(zip_file.cds.keys())
+                elif task == "lookup":
+                    zip_file.has_file(b"AndroidManifest.xml")
+                costs[task] = min(costs[task], time.perf_counter() - start)
+                zip_file.close()
+        assert len(names) == count
+        print(f"{mode}: entries:{count}, " + ", ".join(f"{k}:{v*1000:.1f}ms" for k, v in costs.items()))
+    zip_parser.np = np
 
 if __name__ == "__main__":
     # arsc(1)
     # arsc(2)
-    basic(int(sys.argv[1]))
+    if sys.argv[1] == "zip":
+        # 新旧两种方式分别在单独的进程里运行，rss才有参考价值，如：
+        # python benchmark.py zip legacy; python benchmark.py zip
+        zip_open(legacy=(sys.argv[2:] == ["legacy"]))
+    elif sys.argv[1] == "cd":
+        # 不依赖测试样本，生成条目很多的zip测试中心目录的解析速度，如：python benchmark.py cd 50000
+        central_dir(*map(int, sys.argv[2:3]))
+    else:
+        basic(int(sys.argv[1]))
@@ -1,11 +1,17 @@
 import os,sys
+import hashlib
+import io
+import random
+import struct
+import time
 
 SELF_PATH = os.path.dirname(os.path.realpath(__file__))
 ROOT_PATH = os.path.join(SELF_PATH, "../")
 sys.path.append(ROOT_PATH)
 from parser.zip_parser import ZipFile
-from parser.res_parser import Axml, Arsc
+from parser.res_parser import Axml, Arsc, StringPool, EVENT_START_ELEMENT, EVENT_END_ELEMENT, EVENT_START_NS, EVENT_END_NS
 from main import ApkFile
+from parser.manifest_parser import ANDROID_NS, ManifestIndex
 
 def test_axml_basic():
     zip_file = ZipFile(os.path.join(SELF_PATH ,"apks/normal.apk"))
@@ -21,6 +27,129 @@ def test_axml_basic():
     assert len(axml_1.get_xml_str()) == 9904
     
 
+def test_axml_node():
+    zip_file = ZipFile(os.path.join(SELF_PATH ,"apks/normal.apk"))
+    axml = Axml(zip_file.get_file(b"AndroidManifest.xml"))
+    root = axml.node_ptr
+    assert root.tag == "manifest" and root.getparent() is None
+    application = root.find("application")
+    assert application.getparent() is root
+    assert application in list(root.iter())
+    assert all(node.tag == "activity" for node in root.iter("activity"))
+    assert application.get("not_exist", "default") == "default"
+
+
+def _make_siblings_axml(count:int) -> bytes:
+    '''
+    构造一个根节点下有count个子节点的二进制xml
+    '''
+    strings = b"\x04\x04root\x00" + b"\x04\x04item\x00"
+    strings += b"\x00" * (-len(strings) % 4)
+    string_pool = struct.pack("<HHI5I", 0x0001, 0x1C, 0x1C + 8 + len(strings), 2, 0, 1 << 8, 0x1C + 8, 0)
+    string_pool += struct.pack("<2I", 0, 7) + strings
+
+    def start(name):
+        return struct.pack("<HHI2I2I6H", 0x0102, 0x10, 0x24, 1, 0xffffffff, 0xffffffff, name, 0x14, 0x14, 0, 0, 0, 0)
+    def end(name):
+        return struct.pack("<HHI2I2I", 0x0103, 0x10, 0x18, 1, 0xffffffff, 0xffffffff, name)
+
+    body = string_pool + start(0) + (start(1) + end(1)) * count + end(0)
+    return struct.pack("<HHI", 0x0003, 8, 8 + len(body)) + body
+
+
+def test_many_siblings():
+    # 每个节点O(1)，10万个兄弟节点也能很快解析完
+    data = _make_siblings_axml(100000)
+    start = time.perf_counter()
+    axml = Axml(data)
+    assert time.perf_counter() - start < 10
+    assert axml.node_ptr.tag == "root"
+    assert len(axml.node_ptr) == 100000
+
+
+def test_hostile_string_count():
+    # 头部的字符串数被改成很大的值，名称缓存按实际读到的偏移数分配，不会申请几百MB内存
+    data = bytearray(_make_siblings_axml(3))
+    struct.pack_into("<I", data, 16, 0x08000000)
+    axml = Axml(bytes(data))
+    assert axml.node_ptr.tag == "root"
+    assert [node.tag for node in axml.node_ptr] == ["item"] * 3
+    axml._parse_name(1)
+    assert len(axml._names) <= len(axml.string_pool.string_offsets) < len(data)
+
+
+def test_root_attributes():
+    zip_file = ZipFile(os.path.join(SELF_PATH ,"apks/normal.apk"))
+    data = zip_file.get_file(b"AndroidManifest.xml")
+    axml = Axml(data)
+    attrs = Axml.read_root_attributes(data)
+    assert len(attrs) > 0
+    for attr in axml.start_elements[0].attributes:
+        assert attrs[axml._parse_name(attr.name)] == attr.value.parse_data(axml.string_pool)
+
+
+def test_iter_events():
+    zip_file = ZipFile(os.path.join(SELF_PATH ,"apks/arsc_obf.apk"))
+    data = zip_file.get_file(b"AndroidManifest.xml")
+    nodes = list(Axml(data).node_ptr.iter())
+    events = list(Axml(data, build_tree=False).iter_events())
+    starts = [(tag, attrs) for event, tag, attrs, _ in events if event == EVENT_START_ELEMENT]
+    assert starts == [(node.tag, dict(node.attrib)) for node in nodes]
+    assert len([e for e in events if e[0] == EVENT_END_ELEMENT]) == len(starts)
+    assert events[0][0] == EVENT_START_NS and events[-1][0] == EVENT_END_NS
+
+
+def test_write_xml():
+    from lxml import etree
+    def canon(e):
+        return (e.tag, sorted(e.attrib.items()), [canon(c) for c in e])
+
+    for name in ("normal.apk", "arsc_obf.apk"):
+        zip_file = ZipFile(os.path.join(SELF_PATH ,"apks", name))
+        data = zip_file.get_file(b"AndroidManifest.xml")
+        out = io.StringIO()
+        Axml(data, pre_decode=False, build_tree=False).write_xml(out)
+        # prefix不同(android和ns0)，解析后和xml树的内容一致
+        assert canon(etree.fromstring(out.getvalue().encode())) == canon(etree.fromstring(Axml(data).get_xml_str().encode()))
+
+    out = io.BytesIO()
+    Axml(_make_siblings_axml(3)).write_xml(out, indent="")
+    assert out.getvalue() == b"<?xml version='1.0' encoding='utf-8'?>\n<root><item/><item/><item/></root>\n"
+
+
+def test_manifest_index():
+    apk = ApkFile(os.path.join(SELF_PATH ,"apks/normal.apk"), lazy=True)
+    index = apk.manifest_index
+    # 不需要创建xml树
+    assert "manifest" not in apk.__dict__
+    root = apk.manifest.node_ptr
+    # 创建xml树之后再流式读取，复用同一个字符串池
+    string_pool = apk.manifest.string_pool
+    assert list(apk.manifest.iter_events()) == list(Axml(apk.manifest.buff, build_tree=False).iter_events())
+    assert apk.manifest.string_pool is string_pool
+    assert len(index.activities) == len(list(root.iter("activity"))) + len(list(root.iter("activity-alias")))
+    assert len(index.services) == len(list(root.iter("service")))
+    for component in index.find(action="android.intent.action.MAIN"):
+        assert any("android.intent.action.MAIN" in f.actions for f in component.intent_filters)
+    assert apk.get_main_activity() == ApkFile(os.path.join(SELF_PATH ,"apks/normal.apk")).get_main_activity()
+
+
+def test_manifest_index_attrs():
+    # android:name为空时，和原来一样再取不带命名空间的name
+    events = [
+        (EVENT_START_ELEMENT, "manifest", {"package": "com.example"}, 1),
+        (EVENT_START_ELEMENT, "application", {}, 2),
+        (EVENT_START_ELEMENT, "activity", {ANDROID_NS + "name": "", "name": ".Main"}, 3),
+        (EVENT_END_ELEMENT, "activity", None, 3),
+        (EVENT_START_ELEMENT, "service", {ANDROID_NS + "name": ".Svc", "name": ".Other"}, 4),
+        (EVENT_END_ELEMENT, "service", None, 4),
+        (EVENT_END_ELEMENT, "application", None, 5),
+        (EVENT_END_ELEMENT, "manifest", None, 6),
+    ]
+    index = ManifestIndex(events)
+    assert [c.name for c in index.components] == [".Main", ".Svc"]
+
+
 def test_arsc_basic():
     res = []
     with open(os.path.join(SELF_PATH ,"apks/resources.arsc"),"rb") as fr:
@@ -29,12 +158,223 @@ def test_arsc_basic():
     assert res[0][1] == "res/anim/abc_fade_in.xml"
 
 
+def test_string_pool_lazy():
+    with open(os.path.join(SELF_PATH ,"apks/resources.arsc"),"rb") as fr:
+        arsc = Arsc(fr.read())
+    string_pool = arsc.string_pool
+    # 只解码用到的字符串
+    arsc.get_resources(0x7f010000)
+    assert len(string_pool.strings) < string_pool.string_cnt
+    strings = string_pool.list_strings()
+    assert len(strings) == string_pool.string_cnt
+    assert all(string_pool.get_string(i) == strings[i] for i in range(0, len(strings), 97))
+
+
+def test_string_table():
+    with open(os.path.join(SELF_PATH ,"apks/resources.arsc"),"rb") as fr:
+        arsc = Arsc(fr.read())
+    # 各个语言配置中同名的资源引用同一个字符串
+    package = arsc.table_packages[0x7f]
+    for types in package.tp_types.values():
+        for num in types[0].entries:
+            keys = [item.entries[num].key_str for item in types if num in item.entries]
+            assert all(key is keys[0] for key in keys)
+    assert package.key_str_pool.table is arsc.string_table is arsc.string_pool.table
+    assert len(arsc.string_table) == len(set(arsc.string_table.strings))
+
+
+def test_string_pool_search():
+    with open(os.path.join(SELF_PATH ,"apks/resources.arsc"),"rb") as fr:
+        string_pool = Arsc(fr.read()).string_pool
+    strings = string_pool.list_strings()
+    assert string_pool.search("abc_") == [(i, string) for i, string in enumerate(strings) if "abc_" in string]
+    # 只解码了匹配到的字符串
+    assert len(string_pool.strings) < string_pool.string_cnt
+    res = string_pool.search_many([rb"res/anim/\w+\.xml", "no such string"])
+    assert "res/anim/abc_fade_in.xml" in [string for _, string in res[rb"res/anim/\w+\.xml"]]
+    assert res["no such string"] == []
+
+
+def _make_string_pool(strings, utf8:bool) -> bytes:
+    '''
+    构造只有字符串、没有style的字符串池
+    '''
+    offsets = []
+    data = b""
+    for string in strings:
+        offsets.append(len(data))
+        if utf8:
+            encoded = string.encode("utf-8")
+            data += bytes([len(string.encode("utf-16-le")) // 2, len(encoded)]) + encoded + b"\x00"
+        else:
+            data += struct.pack("<H", len(string.encode("utf-16-le")) // 2) + string.encode("utf-16-le") + b"\x00\x00"
+    data += b"\x00" * (-len(data) % 4)
+    strings_start = 0x1C + 4 * len(strings)
+    return struct.pack("<HHI5I", 0x0001, 0x1C, strings_start + len(data), len(strings), 0,
+                       (1 << 8) if utf8 else 0, strings_start, 0) + struct.pack(f"<{len(strings)}I", *offsets) + data
+
+
+def test_string_pool_search_empty():
+    # 空字符串的数据长度为0，匹配从下一个字符串的长度开始时不能算作空字符串的结果
+    for utf8 in (True, False):
+        string_pool = StringPool(_make_string_pool(["", "a\U0001F600", "b", ""], utf8))
+        assert string_pool.search("a") == [(1, "a\U0001F600")]
+        assert string_pool.search("b") == [(2, "b")]
+        assert string_pool.search("c") == []
+        # 可以匹配0个字节的模式也不会匹配到空字符串
+        assert string_pool.search(rb"a?") == [(1, "a\U0001F600"), (2, "b")]
+
+
+def test_list_strings():
+    # 批量解码和逐个解码的结果一致
+    zip_file = ZipFile(os.path.join(SELF_PATH ,"apks/arsc_obf.apk"))
+    for data in (zip_file.get_file(b"AndroidManifest.xml"), zip_file.get_file(b"resources.arsc")):
+        string_pool = (Axml(data) if data[:2] == b"\x03\x00" else Arsc(data)).string_pool
+        strings = string_pool.list_strings()
+        assert strings == [string_pool.string_at(string_pool.string_offset + offset) for offset in string_pool.string_offsets]
+
+
+def _legacy_utf8_decode(data:bytes) -> str:
+    # 原来的StringPool._my_utf8_decode，作为test_utf8_recover的参照
+    res = []
+
+    data_ptr = 0
+    while (data_ptr < len(data)):
+        tmp_b:int = 0
+
+        if data[data_ptr] & 0x80 == 0:   # 单字节
+            res.append(data[data_ptr] & 0x7f)
+            data_ptr += 1
+        elif data[data_ptr] & 0xE0 == 0xC0:
+            tmp_b += (data[data_ptr] & 0x1F) << 6
+            tmp_b += (data[data_ptr + 1] & 0x3F)
+            res.append(tmp_b)
+            data_ptr += 2
+        elif data[data_ptr] & 0xF0 == 0xE0:
+            tmp_b += (data[data_ptr] & 0xF) << 6*2
+            tmp_b += (data[data_ptr + 1] & 0x3F) << 6
+            tmp_b += (data[data_ptr + 2] & 0x3F)
+            res.append(tmp_b)
+            data_ptr += 3
+        elif data[data_ptr] & 0xF8 == 0xF0:
+            tmp_b += (data[data_ptr] & 0x7) << 6*3
+            tmp_b += (data[data_ptr + 1] & 0x3F) << 6*2
+            tmp_b += (data[data_ptr + 2] & 0x3F) << 6
+            tmp_b += (data[data_ptr + 3] & 0x3F)
+            res.append(tmp_b)
+            data_ptr += 4
+        elif data[data_ptr] & 0xFC == 0xF8:
+            tmp_b += (data[data_ptr] & 0x3) << 6*4
+            tmp_b += (data[data_ptr + 1] & 0x3F) << 6*3
+            tmp_b += (data[data_ptr + 2] & 0x3F) << 6*2
+            tmp_b += (data[data_ptr + 3] & 0x3F) << 6
+            tmp_b += (data[data_ptr + 4] & 0x3F)
+            res.append(tmp_b)
+            data_ptr += 5
+        elif data[data_ptr] & 0xFE == 0xFC:
+            tmp_b += (data[data_ptr] & 0x1) << 6*5
+            tmp_b += (data[data_ptr + 1] & 0x3F) << 6*4
+            tmp_b += (data[data_ptr + 2] & 0x3F) << 6*3
+            tmp_b += (data[data_ptr + 3] & 0x3F) << 6*2
+            tmp_b += (data[data_ptr + 4] & 0x3F) << 6
+            tmp_b += (data[data_ptr + 5] & 0x3F)
+            res.append(tmp_b)
+            data_ptr += 6
+        else:
+            raise Exception(f"decode utf-8 error, bytes:{data}")
+    final_res = ""
+    index = 0
+    while (index < len(res)):
+        if res[index] & 0xFC00 == 0xD800:
+            if res[index + 1] & 0xFC00 == 0xDC00:
+                final_res += (res[index].to_bytes(2, "big") + res[index + 1].to_bytes(2, "big")).decode("utf-16be")
+                index += 2
+                continue
+        elif res[index] & 0xFCFC == 0xD8DC:
+            final_res += res[index].to_bytes(2, "big").decode("utf-16be")
+        else:
+            final_res += chr(res[index])
+        index += 1
+
+    return final_res
+
+
+def _utf8_corpus(count:int) -> list:
+    # 合法的utf-8、modified utf-8(C0 80和分开编码的代理对)、低16位像代理的补充平面字符、5、6字节的形式、截断和非法的字节
+    pieces = [b"a", b"\x00", "中".encode(), "\U0001F600".encode(), "\U0002D800".encode(), "\U0002DC00".encode(),
+              "\ufffd".encode(), b"\xc0\x80", b"\xed\xa0\xbd", b"\xed\xb8\x80", b"\xed\xa0\x80", b"\xed\xb0\x80",
+              b"\xf4\x90\x80\x80", b"\xf0\xad\xa0\x80", b"\xf8\x88\x8d\xa0\x80", b"\xfc\x80\x80\x8d\xa0\x80",
+              b"\xfc\x84\x80\x8d\xa0\x80", b"\xe4\xb8", b"\xe4\x41\x42", b"\x80", b"\xbf", b"\xfe", b"\xff"]
+    rand = random.Random(23)
+    corpus = [b"", b"\xed\xa0\xbd\xed\xb8\x80", b"\xed\xa0\xbd", b"\xed\xa0\xbda", b"\xed\xb8\x80\xed\xa0\xbd\xed\xb8\x80"]
+    for _ in range(count):
+        corpus.append(b"".join(rand.choice(pieces) for _ in range(rand.randint(1, 8))))
+        corpus.append(bytes(rand.randrange(256) for _ in range(rand.randint(1, 12))))
+    return corpus
+
+
+def test_utf8_recover():
+    # 和原来的逐字节解码结果一致，原来抛异常的输入现在也抛异常
+    string_pool = StringPool.__new__(StringPool)
+    for data in _utf8_corpus(20000):
+        try:
+            expected = _legacy_utf8_decode(data)
+        except Exception:
+            expected = Exception
+        try:
+            res = string_pool._my_utf8_decode(data)
+        except Exception:
+            res = Exception
+        assert res == expected, data
+
+
 def test_icon():
     apk = ApkFile(os.path.join(SELF_PATH ,"apks/normal.apk"))
     icon_file = apk.get_file(apk.get_icon().encode())
     assert len(icon_file) == 171658
     
 
+def test_digests():
+    file_path = os.path.join(SELF_PATH ,"apks/normal.apk")
+    with open(file_path, "rb") as fr:
+        data = fr.read()
+    with ApkFile(file_path) as apk:
+        # 默认只计算sha1
+        assert apk.digests() == {"sha1": hashlib.sha1(data).hexdigest()} == {"sha1": apk.sha1}
+    with ApkFile(file_path, digest_algorithms=("md5", "sha256")) as apk:
+        digests = apk.digests()
+        assert digests["sha1"] == hashlib.sha1(data).hexdigest() == apk.sha1
+        assert digests["md5"] == hashlib.md5(data).hexdigest()
+        assert digests["sha256"] == hashlib.sha256(data).hexdigest()
+        assert apk.digests(["sha512"])["sha512"] == hashlib.sha512(data).hexdigest()
+    
+
+def test_lazy():
+    file_path = os.path.join(SELF_PATH ,"apks/normal.apk")
+    apk = ApkFile(file_path)
+    lazy_apk = ApkFile(file_path, lazy=True)
+    # 创建时不解析任何数据，也不在后台计算hash
+    for name in ("manifest", "resources", "common_k_v", "manifest_index"):
+        assert name not in lazy_apk.__dict__
+    assert lazy_apk._digests_future is None
+
+    # 包名和版本号只读取manifest根节点的属性，不是资源id时，不需要解析resources.arsc，也不创建xml树
+    assert lazy_apk.package == apk.package
+    assert lazy_apk.version == apk.version
+    assert "resources" not in lazy_apk.__dict__
+    assert "manifest" not in lazy_apk.__dict__
+
+    # main_activity流式读取manifest建立组件索引，同样不创建xml树
+    assert lazy_apk.main_activity == apk.main_activity
+    assert "manifest" not in lazy_apk.__dict__
+    assert not lazy_apk._digests
+
+    assert lazy_apk.app_name == apk.app_name
+    assert "manifest" in lazy_apk.__dict__
+    assert lazy_apk.sha1 == apk.sha1
+    assert lazy_apk.get_basic_info() == apk.get_basic_info()
+    
+
 if __name__ == "__main__":
     # test_axml_basic()
     test_arsc_basic()
@@ -1,9 +1,31 @@
 import os,sys
+import logging
+import struct
+import tempfile
+import time
+import warnings
+import zipfile
 
 SELF_PATH = os.path.dirname(os.path.realpath(__file__))
 ROOT_PATH = os.path.join(SELF_PATH, "../")
 sys.path.append(ROOT_PATH)
-from parser.zip_parser import ZipFile
+from parser import zip_parser
+from parser.zip_parser import ZipFile, ZipEntrySizeError, find_end_of_central_dirs
+from parser.range_reader import FileRangeReader
+from main import ApkFile
+
+
+class LatencyRangeReader(FileRangeReader):
+    '''
+    模拟对象存储，每次请求都有固定延迟
+    '''
+    def __init__(self, fpath:str, latency:float = 0.01) -> None:
+        super().__init__(fpath)
+        self.latency = latency
+
+    def _read(self, offset:int, length:int) -> bytes:
+        time.sleep(self.latency)
+        return super()._read(offset, length)
 
 def test_basic():
     zip_file = ZipFile(os.path.join(SELF_PATH ,"apks/normal.apk"))
@@ -23,5 +45,267 @@ def test_get_file():
     assert len(res2) == 64104
 
 
+def test_mmap():
+    with ZipFile(os.path.join(SELF_PATH ,"apks/normal.apk")) as zip_file:
+        res = zip_file.get_file(b"AndroidManifest.xml")
+    zip_file2 = ZipFile(os.path.join(SELF_PATH ,"apks/normal.apk"), use_mmap=False)
+    assert res == zip_file2.get_file(b"AndroidManifest.xml")
+    assert zip_file.reader.mmap is None
+
+
+def test_cd_index():
+    zip_file = ZipFile(os.path.join(SELF_PATH ,"apks/mix.apk"))
+    cd_index = zip_file.cd_index
+    row = cd_index.index[b"AndroidManifest.xml"]
+    cd = zip_file.cds[b"AndroidManifest.xml"]
+    assert cd_index.name_at(row) == cd.file_name
+    assert cd_index.local_header_offs[row] == cd.local_header_off
+    assert cd_index.uncompressed_sizes[row] == cd.uncompressed_size
+
+
+def test_open_entry():
+    zip_file = ZipFile(os.path.join(SELF_PATH ,"apks/mix.apk"))
+    with zip_file.open_entry(b"AndroidManifest.xml", chunk_size=1024) as fr:
+        chunks = list(fr)
+    assert max(len(i) for i in chunks) <= 1024
+    assert b"".join(chunks) == zip_file.get_file(b"AndroidManifest.xml")
+
+    try:
+        with zip_file.open_entry(b"AndroidManifest.xml", max_size=1024) as fr:
+            fr.read()
+        assert False
+    except ZipEntrySizeError:
+        pass
+
+
+def test_open_entry_close():
+    # 读取出错时异常还引用着数据，关闭zip时mmap也要能正常关闭
+    zip_file = ZipFile(os.path.join(SELF_PATH ,"apks/normal.apk"))
+    mm = zip_file.reader.mmap
+    try:
+        with zip_file.open_entry(b"classes.dex", max_size=10) as fr:
+            fr.read()
+        assert False
+    except ZipEntrySizeError:
+        zip_file.close()
+    assert mm.closed
+
+    zip_file = ZipFile(os.path.join(SELF_PATH ,"apks/normal.apk"))
+    mm = zip_file.reader.mmap
+    fr = zip_file.open_entry(b"AndroidManifest.xml", chunk_size=1024)
+    fr.read(10)
+    zip_file.close()
+    assert mm.closed
+    fr.close()
+
+
+def test_re_zip():
+    zip_file = ZipFile(os.path.join(SELF_PATH ,"apks/mix.apk"))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out_path = os.path.join(tmp_dir, "out.apk")
+        zip_file.re_zip(out_path)
+        zip_file2 = ZipFile(out_path)
+        assert len(zip_file2.cds) == len(zip_file.cds)
+        assert zip_file2.get_file(b"AndroidManifest.xml") == zip_file.get_file(b"AndroidManifest.xml")
+        zip_file2.close()
+
+
+def test_re_zip_legacy_args():
+    # 以前的 re_zip(tmp_path, out_path, quiet) 还能用，tmp_path和quiet被忽略
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        apk_path = os.path.join(tmp_dir, "in.apk")
+        with zipfile.ZipFile(apk_path, "w") as zf:
+            zf.writestr("a.txt", b"a" * 100)
+        calls = [
+            (("./tmp", "out1.apk"), {}),
+            (("./tmp", "out2.apk", False), {}),
+            ((), {"tmp_path": "./tmp", "out_path": "out3.apk"}),
+        ]
+        with ApkFile(apk_path, lazy=True) as apk:
+            for args, kwargs in calls:
+                args = tuple(os.path.join(tmp_dir, i) if isinstance(i, str) else i for i in args)
+                kwargs = {k: os.path.join(tmp_dir, v) for k, v in kwargs.items()}
+                with warnings.catch_warnings(record=True) as caught:
+                    warnings.simplefilter("always")
+                    apk.re_zip(*args, **kwargs)
+                assert [w.category for w in caught] == [DeprecationWarning]
+            apk.re_zip(os.path.join(tmp_dir, "out4.apk"), align=0)
+        for i in range(1, 5):
+            zip_file = ZipFile(os.path.join(tmp_dir, f"out{i}.apk"))
+            assert zip_file.get_file(b"a.txt") == b"a" * 100
+            zip_file.close()
+        assert not os.path.exists(os.path.join(tmp_dir, "tmp"))
+
+
+def test_unzip_duplicate_names():
+    # 规范化后同名的文件不会同时写同一个输出文件，第一个保留原名，其他的重命名
+    names = ["assets/x.bin", "assets//x.bin", "./assets/x.bin", "../assets/x.bin"]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        apk_path = os.path.join(tmp_dir, "dup.apk")
+        with zipfile.ZipFile(apk_path, "w") as zf:
+            for i, name in enumerate(names):
+                zf.writestr(name, bytes([i]) * 1000000)
+        for _ in range(3):
+            out_path = os.path.join(tmp_dir, "out")
+            with ApkFile(apk_path, lazy=True) as apk:
+                apk.unzip(out_path, workers=4)
+            outputs = sorted(os.listdir(os.path.join(out_path, "assets")))
+            assert outputs == ["x.bin", "x.bin~1", "x.bin~2", "x.bin~3"]
+            for i, name in enumerate(outputs):
+                with open(os.path.join(out_path, "assets", name), "rb") as fr:
+                    assert fr.read() == bytes([i]) * 1000000
+
+
+def test_unzip_max_size():
+    # 超过max_size的文件解压到一半出错，不能留下写了一部分的文件
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        apk_path = os.path.join(tmp_dir, "big.apk")
+        with zipfile.ZipFile(apk_path, "w", zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr("big.bin", os.urandom(5 * 1024 * 1024))
+            zf.writestr("small.bin", b"small")
+        out_path = os.path.join(tmp_dir, "out")
+        for workers in (1, 4):
+            with ApkFile(apk_path, lazy=True) as apk:
+                apk.unzip(out_path, workers=workers, max_size=1024 * 1024)
+            assert not os.path.exists(os.path.join(out_path, "big.bin"))
+            with open(os.path.join(out_path, "small.bin"), "rb") as fr:
+                assert fr.read() == b"small"
+
+
+def test_range_reader():
+    file_path = os.path.join(SELF_PATH ,"apks/normal.apk")
+    reader = LatencyRangeReader(file_path)
+    zip_file = ZipFile(reader)
+    # 只读取了文件尾和中心目录
+    assert reader.requests <= 2
+    assert reader.bytes_read < zip_file.file_size * 0.05
+
+    names = [b"AndroidManifest.xml", b"resources.arsc"]
+    zip_file.prefetch(names)
+    requests = reader.requests
+    with ZipFile(file_path) as zip_file2:
+        for name in names:
+            assert zip_file.get_file(name) == zip_file2.get_file(name)
+    assert reader.requests == requests
+    zip_file.close()
+
+
+def test_block_cache():
+    reader = FileRangeReader(os.path.join(SELF_PATH ,"apks/normal.apk"))
+    zip_file = ZipFile(reader)
+    res = zip_file.get_file(b"AndroidManifest.xml")
+    requests = reader.requests
+    # 第二次读取不再解析header，也不产生IO
+    assert zip_file.has_file(b"AndroidManifest.xml")
+    assert zip_file.get_file(b"AndroidManifest.xml") == res
+    assert reader.requests == requests
+    assert zip_file.reader.hits > 0
+    assert b"AndroidManifest.xml" in zip_file.fhs
+    zip_file.close()
+
+
+def test_fake_end_of_central_dir():
+    with open(os.path.join(SELF_PATH ,"apks/normal.apk"), "rb") as fr:
+        data = fr.read()
+    # 在文件末尾追加伪造的文件尾，真正的文件尾依然排在第一位
+    data += (b"\x50\x4b\x05\x06" + b"\xff" * 18) * 100
+    ecds = find_end_of_central_dirs(data, len(data))
+    assert len(ecds) == 101
+    assert ecds[0].central_dir_size == 48722
+
+
+def test_fake_end_of_central_dir_in_comment():
+    # 注释中伪造的文件尾排在第一位，解析失败后使用真正的文件尾，只有全部失败时才记录error
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, "comment.zip")
+        with zipfile.ZipFile(file_path, "w") as zw:
+            zw.writestr("a", b"a")
+            zw.writestr("b", b"b")
+        with open(file_path, "rb") as fr:
+            data = fr.read()
+        ecd_off = len(data) - 22
+        cd_size, cd_off = struct.unpack_from("<2I", data, ecd_off + 12)
+        # 条目数多一个，中心目录延伸到伪造的文件尾之前，和真正的文件尾得分相同，位置靠后所以先尝试
+        padding = b"\x00" * 64
+        fake_off = ecd_off + 22 + len(padding)
+        fake = struct.pack("<4s4H2IH", b"PK\x05\x06", 0, 0, 3, 3, fake_off - cd_off, cd_off, 0)
+        data = data[:-2] + struct.pack("<H", len(padding + fake)) + padding + fake
+        with open(file_path, "wb") as fw:
+            fw.write(data)
+
+        logger = logging.getLogger("apk_parse")
+        records = []
+        handler = logging.Handler(logging.DEBUG)
+        handler.emit = records.append
+        level = logger.level
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+        try:
+            zip_file = ZipFile(file_path)
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+        assert zip_file.is_init and zip_file.ecd.file_offset == ecd_off
+        assert zip_file.get_file(b"b") == b"b"
+        zip_file.close()
+        assert any(r.levelno == logging.DEBUG and "central dir" in r.getMessage() for r in records)
+        assert not [r for r in records if r.levelno >= logging.ERROR]
+
+
+def test_cd_index_signature_in_name():
+    # 文件名里带有中心目录签名时numpy定位会失败，要退回逐条读取，结果和struct解析一致
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, "sig.zip")
+        with zipfile.ZipFile(file_path, "w") as zw:
+            zw.writestr("a", b"1")
+            zw.writestr("x PK\x01\x02 y", b"22" * 100, zipfile.ZIP_DEFLATED)
+            zw.writestr("a", b"333")
+
+        results = []
+        np = zip_parser.np
+        try:
+            for use_np in (True, False):
+                zip_parser.np = np if use_np else None
+                zip_file = ZipFile(file_path)
+                cd_index = zip_file.cd_index
+                results.append((cd_index.record_offs.tolist(), cd_index.local_header_offs.tolist(),
+                                cd_index.compressed_sizes.tolist(), list(cd_index.iter_names()), cd_index.index))
+                assert zip_file.get_file(b"x PK\x01\x02 y") == b"22" * 100
+                zip_file.close()
+        finally:
+            zip_parser.np = np
+        assert results[0] == results[1]
+        assert results[0][-1] == {b"a": 2, b"x PK\x01\x02 y": 1}
+
+
+def test_cd_list_names():
+    # 只遍历文件名时不创建文件名索引，重名的文件只列一次，顺序和以前的dict一致
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, "names.zip")
+        with zipfile.ZipFile(file_path, "w") as zw:
+            for name in ("b", "a", "b", "c"):
+                zw.writestr(name, name.encode())
+        zip_file = ZipFile(file_path)
+        assert list(zip_file.cds.keys()) == [b"b", b"a", b"c"]
+        assert zip_file.cd_index.list_names() == [b"b", b"a", b"b", b"c"]
+        if zip_parser.np is not None:
+            assert zip_file.cd_index._index is None
+        assert zip_file.cd_index.index == {b"b": 2, b"a": 1, b"c": 3}
+        assert list(zip_file.cds) == [b"b", b"a", b"c"]
+        zip_file.close()
+
+
+def test_not_zip():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, "not_zip.apk")
+        with open(file_path, "wb") as fw:
+            fw.write(b"not a zip file" * 100)
+        zip_file = ZipFile(file_path)
+        assert not zip_file.is_init
+        assert not zip_file.has_file(b"AndroidManifest.xml")
+        zip_file.prefetch([b"AndroidManifest.xml"])
+        zip_file.close()
+
+
 if __name__ == "__main__":
     test_get_file()